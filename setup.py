@@ -8,6 +8,14 @@ setup(
     install_requires=[
         'lxml',
     ],
+    entry_points={
+        'console_scripts': [
+            'treedlib-extract=treedlib.parallel:main',
+            'treedlib-bench=treedlib.bench:main',
+            'treedlib-dict-sub=treedlib.dictsub:main',
+            'treedlib-dsr=treedlib.dsr:main',
+        ],
+    },
     classifiers=[
         "License :: OSI Approved :: MIT License",
     ],
@@ -1,10 +1,85 @@
-import os
+"""
+treedlib submodules are loaded lazily, on first access of one of their names, so that
+`import treedlib` itself is cheap (e.g. for workers & command line tools which only need
+a few of the libs); `from treedlib import *` still loads everything
+"""
+import importlib
 
-# Set TREEDLIB_APP env var, for use in libs we load
-os.environ["TREEDLIB_LIB"] = os.path.dirname(os.path.realpath(__file__))
+# The treedlib libs, in the order in which their names are exported (later ones win)
+_MODULES = ['util', 'writers', 'structs', 'paths', 'profiling', 'hashing', 'vocab', 'calibrate',
+            'cache', 'dictsub', 'incremental', 'templates', 'dsr', 'features']
 
-# Load treedlib libs
-from treedlib.util import *
-from treedlib.structs import *
-from treedlib.templates import *
-from treedlib.features import *
+# Lib -> the public names it defines: this is just a fast path, as names missing from here are
+# still found by loading all the libs (see __getattr__)
+_DEFINES = {
+  'util' : ['print_gen', 'print_error', 'BOOL_PARSER', 'TYPE_PARSERS', 'COPY_ESCAPES',
+            'COPY_ESCAPE_RGX', 'copy_unescape', 'PG_ARRAY_TOKEN_RGX', 'PG_ARRAY_ESCAPE_RGX',
+            'parse_pg_array', 'compile_ptsv_parser', 'parse_ptsv_element', 'Row', 'row_class', 'PTSVParser',
+            'copy_escape', 'pg_array_escape', 'list_to_pg_array', 'format_tsv', 'print_tsv'],
+  'writers' : ['COPY_BUFFER_SIZE', 'PG_COPY_HEADER', 'PG_COPY_TRAILER', 'PG_BINARY_TYPES',
+               'compile_binary_row_encoder', 'CopyWriter', 'shard_paths', 'ShardedCopyWriter'],
+  'structs' : ['APP_HOME', 'XMLTree', 'corenlp_to_xmltree', 'corenlp_to_xmltree_sub',
+               'ArrayTree', 'corenlp_to_arraytree', 'singular',
+               'html_table_to_xmltree', 'html_table_to_xmltree_sub'],
+  'paths' : ['TreePaths', 'TREE_CACHE_SIZE', 'tree_paths'],
+  'profiling' : ['OpProfile', 'Profiler'],
+  'hashing' : ['FeatureHasher'],
+  'vocab' : ['FeatureVocabulary', 'SparseFeatureMatrix', 'feature_matrix'],
+  'calibrate' : ['LengthSketch', 'LengthBinCalibrator', 'calibrate_length_bins'],
+  'cache' : ['INDEX_RECORD', 'row_key', 'TreeCache'],
+  'dictsub' : ['DICT_SUB_CACHE_SIZE', 'write_dict_sub_index', 'build_dict_sub_index', 'DictSubIndex'],
+  'incremental' : ['template_fingerprint', 'IncrementalCompile'],
+  'templates' : ['XPATH_CACHE_SIZE', 'compile_xpath', 'compile_nodeset_xpath', 'xpath_nodes',
+                 'NodeSet', 'node_getter', 'sentence_nodes', 'seq_nodes', 'Mention',
+                 'LeftSiblings', 'RightSiblings', 'Children', 'Parents', 'Between',
+                 'SeqBetween', 'Filter', 'shared_nodes', 'compile_dict_sub', 'Indicator',
+                 'NGRAM_OUTPUTS', 'MASK64', 'MASK63', 'NGRAM_HASH_MULT', 'ngram_hashes', 'Ngrams',
+                 'RightNgrams', 'LeftNgrams', 'RGX_GRAM', 'key_cost', 'regex_keys',
+                 'RegexMatcher', 'RegexpBank', 'Regexp', 'LengthBin', 'PhraseMatcher',
+                 'DictionaryIntersect', 'Combinator', 'Combinations', 'Compile', 'et'],
+  'dsr' : ['flat_tree', 'build_path_index', 'PathIndex', 'read_candidate_rows'],
+  'features' : ['compile_relation_feature_generator', 'relation_feature_templates',
+                'get_relation_binning_features'],
+}
+
+# Name -> the lib it is loaded from
+_EXPORTS = {}
+for _m in _MODULES:
+  for _name in _DEFINES[_m]:
+    _EXPORTS[_name] = _m
+del _m, _name
+
+
+def _load_all():
+  """Load all the libs, exporting all their public names as the eager star imports did"""
+  names = {}
+  for m in _MODULES:
+    mod = importlib.import_module('treedlib.' + m)
+    for name in getattr(mod, '__all__', [n for n in vars(mod) if not n.startswith('_')]):
+      names[name] = getattr(mod, name)
+  globals().update(names)
+  globals()['__all__'] = all_names = list(names)
+  return all_names
+
+
+def __getattr__(name):
+  if name == '__all__':
+    return _load_all()
+  if name in _EXPORTS:
+    mod = importlib.import_module('treedlib.' + _EXPORTS[name])
+    if hasattr(mod, name):
+      value = globals()[name] = getattr(mod, name)
+      return value
+  if name in _MODULES or name in ('parallel', 'bench'):
+    return importlib.import_module('treedlib.' + name)
+
+  # A name missing from (or moved since) _DEFINES: load everything, as the star imports did
+  if '__all__' not in globals():
+    _load_all()
+    if name in globals():
+      return globals()[name]
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+  return sorted(set(globals()).union(_EXPORTS))
@@ -0,0 +1,323 @@
+"""
+Feature extraction throughput benchmarks
+Generates synthetic CoreNLP-style sentences of controlled length, dependency tree depth and
+number of candidates (deterministically, given the seed), and measures sentences/sec and
+features/sec for tree building, each template class, the full relation feature pipeline and
+writing its output, along with peak memory, as well as the cold import time of the package
+(in a fresh interpreter). Results can be saved as a baseline, and later runs compared against
+it to catch performance regressions.
+
+Example:
+  python -m treedlib.bench --length 40 --depth 10 --candidates 20 --save bench.json
+  python -m treedlib.bench --length 40 --depth 10 --candidates 20 --baseline bench.json
+"""
+from collections import OrderedDict
+import argparse
+import gc
+import os
+import json
+import platform
+import random
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import lxml.etree as et
+from treedlib.util import print_error, format_tsv
+from treedlib.structs import corenlp_to_xmltree, corenlp_to_arraytree
+from treedlib.templates import *
+from treedlib.features import compile_relation_feature_generator
+from treedlib.writers import CopyWriter
+
+
+# SYNTHETIC DATA:
+# ===========
+
+POSES = ['NN', 'NNS', 'NNP', 'VB', 'VBD', 'VBZ', 'VBN', 'JJ', 'RB', 'IN', 'DT', 'CC', 'PRP']
+DEP_LABELS = ['nsubj', 'dobj', 'amod', 'det', 'prep', 'pobj', 'nn', 'advmod', 'cc', 'conj', 'aux', 'dep']
+NERS = ['O'] * 8 + ['PERSON', 'ORGANIZATION', 'LOCATION', 'GENE']
+SYLLABLES = ['ka', 'lo', 'mi', 'ren', 'tu', 'sa', 'vi', 'dor', 'pe', 'qua', 'zin', 'bel', 'o', 'a']
+
+def synthetic_vocab(n, rng):
+  """A vocabulary of n distinct pseudo-words"""
+  vocab = set()
+  while len(vocab) < n:
+    vocab.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+  return sorted(vocab)
+
+def synthetic_sentence(length, depth, rng, vocab):
+  """
+  A random CoreNLP-style sentence dict of the given length, with a dependency tree of the
+  given depth (counting the root word as depth 1)
+  """
+  depth = max(1, min(depth, length))
+  order = list(range(1, length + 1))
+  rng.shuffle(order)
+
+  # A chain of depth words guarantees the depth; the rest attach anywhere above the bottom
+  dep_parents = [0] * length
+  depths = {0 : 0}
+  for p, w in zip([0] + order[:depth-1], order[:depth]):
+    dep_parents[w-1] = p
+    depths[w] = depths[p] + 1
+  shallow = order[:depth-1] or [0]
+  for w in order[depth:]:
+    p = rng.choice(shallow)
+    dep_parents[w-1] = p
+    depths[w] = depths[p] + 1
+    if depths[w] < depth:
+      shallow.append(w)
+
+  words = [rng.choice(vocab) for _ in range(length)]
+  words = [w.capitalize() if rng.random() < 0.1 else w for w in words]
+  char_offsets = []
+  o = 0
+  for w in words:
+    char_offsets.append(o)
+    o += len(w) + 1
+  return {
+    'words' : words,
+    'lemmas' : [w.lower() for w in words],
+    'poses' : [rng.choice(POSES) for _ in range(length)],
+    'ners' : [rng.choice(NERS) for _ in range(length)],
+    'char_offsets' : char_offsets,
+    'dep_labels' : ['ROOT' if p == 0 else rng.choice(DEP_LABELS) for p in dep_parents],
+    'dep_parents' : dep_parents
+  }
+
+def synthetic_candidates(length, n, rng, max_mention_len=2):
+  """n random binary relation candidates, i.e. pairs of non-overlapping word index spans"""
+  cands = []
+  while len(cands) < n and length > 1:
+    spans = []
+    for _ in range(2):
+      l = rng.randint(1, min(max_mention_len, length // 2))
+      s = rng.randint(0, length - l)
+      spans.append(list(range(s, s + l)))
+    if len(set(spans[0]).intersection(spans[1])) == 0:
+      cands.append(spans)
+  return cands
+
+def synthetic_corpus(n_sentences=200, length=30, depth=8, n_candidates=10, vocab_size=500, seed=0):
+  """
+  Get a list of (sentence dict, candidates) pairs, and a dictionary of phrases some of which
+  occur in the sentences
+  """
+  rng = random.Random(seed)
+  vocab = synthetic_vocab(vocab_size, rng)
+  dictionary = rng.sample(vocab, vocab_size // 10) + [' '.join(rng.sample(vocab, 2)) for _ in range(vocab_size // 10)]
+  corpus = [(synthetic_sentence(length, depth, rng, vocab), synthetic_candidates(length, n_candidates, rng)) for _ in range(n_sentences)]
+  return corpus, dictionary
+
+
+# BENCHMARKS:
+# ===========
+
+def template_classes(dictionary):
+  """A representative instance of each template class"""
+  m0 = Mention(0)
+  m1 = Mention(1)
+  btwn = Between(m0, m1)
+  return OrderedDict([
+    ('Between', Indicator(btwn, 'dep_label,lemma')),
+    ('Parents', Ngrams(Parents(btwn, 3), 'lemma', (1,3))),
+    ('Siblings', LeftNgrams(LeftSiblings(m0), 'lemma')),
+    ('Ngrams', Ngrams(btwn, 'lemma', (1,3))),
+    ('SeqNgrams', Ngrams(SeqBetween(), 'lemma', (1,3))),
+    ('LengthBin', LengthBin(btwn, [3,4,6])),
+    ('DictionaryIntersect', DictionaryIntersect(SeqBetween(), 'DICT', dictionary)),
+    ('Combinations', Combinations(LengthBin(SeqBetween(), [5,8,14]), Ngrams(Filter(btwn, 'pos', 'VB'), 'lemma', (1,2)))),
+    ('Regexp', Regexp(SeqBetween(), 'lemma', r'\b(?:ka|lo)\w* (?:\w+ )?mi', 'KA-MI')),
+    ('RegexpBank', RegexpBank(SeqBetween(), 'lemma', [(r'\b%s\b' % re.escape(p), 'D%d' % i) for i, p in enumerate(dictionary)]))
+  ])
+
+def _build_trees(corpus, to_tree):
+  return sum(1 for s, _ in corpus if to_tree(s) is not None), 0
+
+def _apply_batch(trees, corpus, generator):
+  n = 0
+  for tree, (_, cands) in zip(trees, corpus):
+    for _ in generator(tree, cands):
+      n += 1
+  return len(trees), n
+
+def _pipeline(corpus, to_tree, generator):
+  n = 0
+  for s, cands in corpus:
+    for _ in generator(to_tree(s), cands):
+      n += 1
+  return len(corpus), n
+
+def _write_lines(corpus, records):
+  with open(os.devnull, 'w') as f:
+    for r in records:
+      f.write(format_tsv(r) + '\n')
+  return len(corpus), len(records)
+
+def _write_copy(corpus, records, **kwargs):
+  with CopyWriter(os.devnull, **kwargs) as w:
+    w.write_many(records)
+  return len(corpus), len(records)
+
+# Times an import in a fresh interpreter, i.e. without any of its modules already loaded
+IMPORT_TIMER = "import time; t = time.perf_counter(); %s; print(time.perf_counter() - t)"
+
+def _cold_import(stmt):
+  out = subprocess.check_output([sys.executable, '-c', IMPORT_TIMER % stmt])
+  return 0, 0, float(out)
+
+def benchmarks(corpus, dictionary, only=None):
+  """
+  Get the benchmarks, as (name, fn) pairs where fn() returns (# sentences, # features), or
+  (0, 0, seconds) for benchmarks which time themselves (i.e. cold imports)
+  Template benchmarks run over prebuilt xml trees, i.e. exclude tree building
+  """
+  xml_tree = lambda s : corenlp_to_xmltree(s).root
+  benches = [
+    ('import:treedlib', lambda : _cold_import('import treedlib')),
+    ('import:templates', lambda : _cold_import('from treedlib import Compile')),
+    ('import:all', lambda : _cold_import('from treedlib import *')),
+    ('tree:corenlp_to_xmltree', lambda : _build_trees(corpus, xml_tree)),
+    ('tree:corenlp_to_arraytree', lambda : _build_trees(corpus, corenlp_to_arraytree))
+  ]
+  trees = None
+  if only is None or any(name.startswith('template:') for name in only):
+    trees = [xml_tree(s) for s, _ in corpus]
+  for name, t in template_classes(dictionary).items():
+    benches.append(('template:%s' % name, lambda g=Compile([t]).apply_batch : _apply_batch(trees, corpus, g)))
+  g = compile_relation_feature_generator(dictionaries={'DICT' : dictionary}, is_batch=True)
+  benches.append(('pipeline:xmltree', lambda : _pipeline(corpus, xml_tree, g)))
+  benches.append(('pipeline:arraytree', lambda : _pipeline(corpus, corenlp_to_arraytree, g)))
+
+  # Writing the pipeline output, as (candidate id, feature) records
+  records = []
+  if only is None or any(name.startswith('output:') for name in only):
+    for i, (s, cands) in enumerate(corpus):
+      records.extend(('%d_%d' % (i, k), f) for k, f in g(corenlp_to_arraytree(s), cands))
+  benches.append(('output:lines', lambda : _write_lines(corpus, records)))
+  benches.append(('output:copy_text', lambda : _write_copy(corpus, records)))
+  benches.append(('output:copy_binary', lambda : _write_copy(corpus, records, types=['text', 'text'], binary=True)))
+  return [(name, fn) for name, fn in benches if only is None or name in only]
+
+def run_benchmark(fn, repeat=3):
+  """Run fn repeat times, getting the best time, and then once more to get its peak memory"""
+  best = None
+  for _ in range(repeat):
+    gc.collect()
+    t = time.perf_counter()
+    r = fn()
+    t = time.perf_counter() - t if len(r) == 2 else r[2]
+    n_sents, n_feats = r[:2]
+    best = t if best is None else min(best, t)
+
+  # Note: tracemalloc only sees the python heap, not e.g. libxml2's allocations
+  gc.collect()
+  tracemalloc.start()
+  fn()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return {
+    'seconds' : best,
+    'sentences' : n_sents,
+    'features' : n_feats,
+    'sents_per_sec' : n_sents / best if best > 0 else 0.0,
+    'feats_per_sec' : n_feats / best if best > 0 else 0.0,
+    'peak_kb' : peak / 1024.0
+  }
+
+def run_benchmarks(n_sentences=200, length=30, depth=8, n_candidates=10, seed=0, repeat=3, only=None, verbose=False):
+  """Run the benchmarks, returning a results dict which can be saved & compared against"""
+  config = OrderedDict([('sentences', n_sentences), ('length', length), ('depth', depth),
+                        ('candidates', n_candidates), ('seed', seed), ('repeat', repeat)])
+  corpus, dictionary = synthetic_corpus(n_sentences, length, depth, n_candidates, seed=seed)
+  results = OrderedDict()
+  for name, fn in benchmarks(corpus, dictionary, only=only):
+    results[name] = run_benchmark(fn, repeat=repeat)
+    if verbose:
+      sys.stderr.write('%s: %.1f ms, %.1f sents/sec\n' % (name, 1000 * results[name]['seconds'], results[name]['sents_per_sec']))
+  return {
+    'config' : config,
+    'env' : {'python' : platform.python_version(), 'lxml' : '.'.join(map(str, et.LXML_VERSION)), 'machine' : platform.machine()},
+    'max_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'results' : results
+  }
+
+def compare(res, baseline, tolerance=0.1):
+  """
+  Compare results against baseline results, getting a list of (benchmark name, message) for
+  each throughput regression of more than tolerance, or change in the number of features
+  Benchmarks without sentences (i.e. cold imports) are compared by time instead
+  """
+  regressions = []
+  if res['config'] != baseline['config']:
+    print_error("Benchmark config %s differs from the baseline config %s" % (dict(res['config']), dict(baseline['config'])))
+  for name, r in res['results'].items():
+    b = baseline['results'].get(name)
+    if b is None:
+      continue
+    if r['sentences'] == 0:
+      if r['seconds'] > b['seconds'] / (1.0 - tolerance):
+        regressions.append((name, 'time %.1f -> %.1f ms' % (1000 * b['seconds'], 1000 * r['seconds'])))
+    elif r['sents_per_sec'] < (1.0 - tolerance) * b['sents_per_sec']:
+      regressions.append((name, 'throughput %.1f -> %.1f sents/sec' % (b['sents_per_sec'], r['sents_per_sec'])))
+    if r['features'] != b['features']:
+      regressions.append((name, '# features %d -> %d' % (b['features'], r['features'])))
+  return regressions
+
+def report(res, baseline=None):
+  """Get a table of the results, with the speedup vs. the baseline if provided"""
+  lines = ['%-32s %10s %10s %12s %10s %10s %8s' % ('benchmark', 'ms', 'sents/sec', 'feats/sec', 'features', 'peak KB', 'vs base')]
+  for name, r in res['results'].items():
+    b = baseline['results'].get(name) if baseline is not None else None
+    vs = '-'
+    if b is not None and r['sentences'] == 0 and r['seconds'] > 0:
+      vs = '%.2fx' % (b['seconds'] / r['seconds'])
+    elif b is not None and b['sents_per_sec'] > 0:
+      vs = '%.2fx' % (r['sents_per_sec'] / b['sents_per_sec'])
+    lines.append('%-32s %10.1f %10.1f %12.1f %10d %10.1f %8s' % (name, 1000 * r['seconds'], r['sents_per_sec'], r['feats_per_sec'], r['features'], r['peak_kb'], vs))
+  lines.append('max RSS: %d KB' % res['max_rss_kb'])
+  return '\n'.join(lines)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="treedlib feature extraction benchmarks over synthetic sentences")
+  parser.add_argument('-n', '--sentences', type=int, default=200)
+  parser.add_argument('--length', type=int, default=30, help="Words per sentence")
+  parser.add_argument('--depth', type=int, default=8, help="Dependency tree depth")
+  parser.add_argument('--candidates', type=int, default=10, help="Relation candidates per sentence")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--repeat', type=int, default=3, help="Repeats per benchmark; the best time is taken")
+  parser.add_argument('--only', default=None, help="Comma-separated benchmark names to run")
+  parser.add_argument('--list', action='store_true', help="List the benchmark names")
+  parser.add_argument('--save', default=None, help="Save the results as a baseline to this path")
+  parser.add_argument('--baseline', default=None, help="Compare against the baseline saved at this path")
+  parser.add_argument('--tolerance', type=float, default=0.1, help="Max allowed fractional slowdown vs. the baseline")
+  args = parser.parse_args(argv)
+
+  if args.list:
+    print('\n'.join(name for name, _ in benchmarks([], [])))
+    return 0
+  res = run_benchmarks(args.sentences, args.length, args.depth, args.candidates, seed=args.seed,
+                       repeat=args.repeat, only=args.only.split(',') if args.only else None, verbose=True)
+  baseline = None
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  print(report(res, baseline))
+  if args.save is not None:
+    with open(args.save, 'w') as f:
+      json.dump(res, f, indent=2)
+
+  # Exit non-zero on any regression, e.g. for use in CI
+  if baseline is not None:
+    regressions = compare(res, baseline, tolerance=args.tolerance)
+    for name, msg in regressions:
+      print_error('REGRESSION %s: %s' % (name, msg))
+    return 1 if len(regressions) > 0 else 0
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
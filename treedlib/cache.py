@@ -0,0 +1,136 @@
+"""
+Persistent, content-addressed on-disk cache of ArrayTrees
+Trees are keyed by a hash of the raw sentence row, so that repeated feature runs over the same
+corpus can skip parsing & tree construction entirely. Trees are stored in ArrayTree.to_bytes
+form, appended to a single data file which is read via mmap; a separate append-only index
+file holds fixed-size (key, offset, length) records. Appends are guarded by a file lock, so
+several processes can share a cache.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+from treedlib.structs import ArrayTree
+
+INDEX_RECORD = struct.Struct('<16sQI')
+
+
+def row_key(row, prune_root=True):
+  """
+  Get the content address of a sentence row- either its raw text (e.g. the sentence columns of
+  a PTSV line) or a list/tuple of raw column strings
+  """
+  if isinstance(row, (list, tuple)):
+    row = '\t'.join(row)
+  if isinstance(row, str):
+    row = row.encode('utf-8')
+  person = b'treedlib-%d-%d' % (ArrayTree.VERSION, int(prune_root))
+  return hashlib.blake2b(row, digest_size=16, person=person).digest()
+
+
+class TreeCache:
+  """An on-disk cache of ArrayTrees at directory path (created if needed)"""
+  def __init__(self, path, readonly=False):
+    self.path = path
+    self.readonly = readonly
+    if not readonly:
+      os.makedirs(path, exist_ok=True)
+    self.data_path = os.path.join(path, 'trees.bin')
+    self.index_path = os.path.join(path, 'trees.idx')
+    for p in (self.data_path, self.index_path):
+      if not (readonly or os.path.exists(p)):
+        open(p, 'ab').close()
+    self.index = {}
+    self.hits = 0
+    self.misses = 0
+    self._index_size = 0
+    self._mm = None
+    self._mm_size = 0
+    self._data_f = None if readonly else open(self.data_path, 'ab')
+    self._index_f = None if readonly else open(self.index_path, 'ab')
+    self._refresh()
+
+  def _refresh(self):
+    """Read any index records appended (e.g. by other processes) since we last looked"""
+    if not os.path.exists(self.index_path):
+      return
+    with open(self.index_path, 'rb') as f:
+      f.seek(self._index_size)
+      buf = f.read()
+    buf = buf[:len(buf) - len(buf) % INDEX_RECORD.size]
+    for key, off, length in INDEX_RECORD.iter_unpack(buf):
+      self.index[key] = (off, length)
+    self._index_size += len(buf)
+
+  def _map(self, end):
+    """Ensure the data file is mapped at least up to end"""
+    if end > self._mm_size:
+      with open(self.data_path, 'rb') as f:
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      self._mm_size = len(self._mm)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, key):
+    return key in self.index
+
+  def get(self, key):
+    """Get the tree for key, or None if not in the cache"""
+    rec = self.index.get(key)
+    if rec is None:
+      self.misses += 1
+      return None
+    off, length = rec
+    self._map(off + length)
+    self.hits += 1
+    return ArrayTree.from_bytes(memoryview(self._mm)[off:off + length])
+
+  def put(self, key, tree):
+    """Add the tree for key to the cache (if not already added, e.g. by another process)"""
+    if self.readonly:
+      return
+    data = tree.to_bytes()
+    fcntl.flock(self._index_f, fcntl.LOCK_EX)
+    try:
+      self._refresh()
+      if key in self.index:
+        return
+
+      # Note: the data is written before the index record, so that readers never see partial trees
+      off = self._data_f.seek(0, os.SEEK_END)
+      self._data_f.write(data)
+      self._data_f.flush()
+      self._index_f.write(INDEX_RECORD.pack(key, off, len(data)))
+      self._index_f.flush()
+      self._index_size += INDEX_RECORD.size
+      self.index[key] = (off, len(data))
+    finally:
+      fcntl.flock(self._index_f, fcntl.LOCK_UN)
+
+  def tree(self, row, build, prune_root=True):
+    """Get the tree for a sentence row (see row_key), calling build() & caching it on a miss"""
+    key = row_key(row, prune_root=prune_root)
+    t = self.get(key)
+    if t is None:
+      t = build()
+      self.put(key, t)
+    return t
+
+  def close(self):
+    for f in (self._data_f, self._index_f):
+      if f is not None:
+        f.close()
+    self._data_f = self._index_f = None
+    self._mm = None
+    self._mm_size = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __repr__(self):
+    return '<%s %s: %d trees>' % (self.__class__.__name__, self.path, len(self))
@@ -0,0 +1,104 @@
+"""
+Streaming calibration of LengthBin bin_divs
+Rather than generating full-path string features and computing percentiles offline, we measure
+the node set lengths directly, and keep a bounded-memory quantile sketch per node set
+"""
+from collections import OrderedDict
+from treedlib.templates import Indicator, Mention, Between, SeqBetween
+
+
+class LengthSketch:
+  """
+  Streaming quantile sketch for node set lengths
+  Since lengths are small non-negative ints, we keep exact counts- lengths above max_length are
+  clamped to it, so memory is bounded by max_length regardless of the corpus size
+  Sketches are mergeable, e.g. across workers
+  """
+  def __init__(self, max_length=1024):
+    self.max_length = max_length
+    self.counts = {}
+    self.n = 0
+
+  def add(self, l, count=1):
+    l = min(l, self.max_length)
+    self.counts[l] = self.counts.get(l, 0) + count
+    self.n += count
+
+  def merge(self, other):
+    for l, c in other.counts.items():
+      self.add(l, c)
+
+  def percentile(self, p):
+    """Get the (lower) p-th percentile length, for p in [0, 100], or None if empty"""
+    if self.n == 0:
+      return None
+    target = p / 100.0 * self.n
+    cum = 0
+    for l in sorted(self.counts):
+      cum += self.counts[l]
+      if cum >= target:
+        return l
+    return max(self.counts)
+
+  def bin_divs(self, percentiles=(25, 50, 75)):
+    """
+    Get bin_divs for LengthBin, such that the bins end at the given percentiles
+    Duplicate divs (e.g. from a narrow distribution) are dropped
+    """
+    divs = []
+    for p in percentiles:
+      l = self.percentile(p)
+      if l is not None and (len(divs) == 0 or l + 1 > divs[-1]):
+        divs.append(l + 1)
+    return divs
+
+  def __repr__(self):
+    return '<%s: n=%d, %s>' % (self.__class__.__name__, self.n, sorted(self.counts.items()))
+
+
+class LengthBinCalibrator:
+  """
+  Measures the lengths of node sets (by default Between(Mention(0), Mention(1)) & SeqBetween())
+  over a stream of trees & candidates, as LengthBin would count them
+  Empty node sets (e.g. SeqBetween of adjacent mentions) are skipped unless count_empty, as
+  LengthBin outputs no feature for them
+  """
+  def __init__(self, nodesets=None, max_length=1024, count_empty=False):
+    if nodesets is None:
+      nodesets = OrderedDict([('BETWEEN', Between(Mention(0), Mention(1))), ('SEQ', SeqBetween())])
+    self.inds = OrderedDict((name, Indicator(ns, 'word')) for name, ns in nodesets.items())
+    self.sketches = OrderedDict((name, LengthSketch(max_length)) for name in nodesets)
+    self.count_empty = count_empty
+
+  def update(self, root, cids, cid_attrib='word_idx', stopwords=None, memo=None):
+    """Add the node set lengths for a single candidate"""
+    for name, ind in self.inds.items():
+      l = len(ind._get_nodes(root, cids, cid_attrib, stopwords=stopwords, memo=memo))
+      if l > 0 or self.count_empty:
+        self.sketches[name].add(l)
+
+  def update_batch(self, root, cands, cid_attrib='word_idx', stopwords=None):
+    """Add the node set lengths for a batch of candidates in the same tree"""
+    memo = {}
+    for cids in cands:
+      self.update(root, cids, cid_attrib, stopwords=stopwords, memo=memo)
+
+  def merge(self, other):
+    for name, sketch in other.sketches.items():
+      self.sketches[name].merge(sketch)
+
+  def bin_divs(self, percentiles=(25, 50, 75)):
+    """Get the LengthBin bin_divs for each node set"""
+    return OrderedDict((name, s.bin_divs(percentiles)) for name, s in self.sketches.items())
+
+
+def calibrate_length_bins(rows, percentiles=(25, 50, 75), nodesets=None, max_length=1024, count_empty=False):
+  """
+  Stream over (tree, cands) pairs, where cands is a list of candidates in the tree, and get
+  the LengthBin bin_divs for each node set, e.g. {'BETWEEN': [3,4,6], 'SEQ': [5,8,14]}
+  By default only non-empty node sets are counted, as in the features of the offline workflow
+  """
+  c = LengthBinCalibrator(nodesets, max_length=max_length, count_empty=count_empty)
+  for root, cands in rows:
+    c.update_batch(root, cands)
+  return c.bin_divs(percentiles)
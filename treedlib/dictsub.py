@@ -0,0 +1,155 @@
+"""
+Compact, memory-mapped dictionary substitution (word -> DICT_LABEL, e.g. Brown cluster) index
+The word -> label mapping built by compile_dict_sub is written once to a single file, which
+processes then mmap & look words up in directly, rather than each reading the cluster TSV into
+a dict of its own; the pages are shared by all the processes on a machine. An index can be used
+anywhere a dict_sub dict is accepted, e.g. Compile.apply_batch(..., dict_sub=DictSubIndex(path))
+
+Layout: the header, then the sorted uint64 key hashes, the uint64 key offsets, the uint64 label
+offsets and the uint32 label ids of the entries, then the key & label blobs
+"""
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+
+DICT_SUB_CACHE_SIZE = 65536
+
+
+def _key_hash(key):
+  return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def write_dict_sub_index(path, dict_sub):
+  """Write a word -> label mapping (e.g. from compile_dict_sub) as an index file at path"""
+  entries = sorted((_key_hash(w.encode('utf-8')), w.encode('utf-8'), label) for w, label in dict_sub.items())
+  label_ids = {}
+  hashes, key_offs, ids = array('Q'), array('Q', [0]), array('I')
+  keys = bytearray()
+  for h, key, label in entries:
+    hashes.append(h)
+    keys += key
+    key_offs.append(len(keys))
+    ids.append(label_ids.setdefault(label, len(label_ids)))
+  label_offs = array('Q', [0])
+  labels = bytearray()
+  for label in label_ids:
+    labels += label.encode('utf-8')
+    label_offs.append(len(labels))
+
+  # Note: written to a temp file & moved into place, so that readers never see a partial index
+  with open(path + '.tmp', 'wb') as f:
+    f.write(DictSubIndex.HEADER.pack(DictSubIndex.MAGIC, DictSubIndex.VERSION, 0, len(entries), len(label_ids)))
+    for a in (hashes, key_offs, label_offs, ids):
+      f.write(a.tobytes())
+    f.write(keys)
+    f.write(labels)
+  os.replace(path + '.tmp', path)
+
+def build_dict_sub_index(path, brown_clusters_path=None, user_dicts=[]):
+  """Build an index file at path of the compile_dict_sub mapping of the same arguments"""
+  from treedlib.templates import compile_dict_sub
+  write_dict_sub_index(path, compile_dict_sub(brown_clusters_path, user_dicts))
+
+
+class DictSubIndex:
+  """
+  A read-only word -> label mapping, memory-mapped from an index file written by
+  write_dict_sub_index; lookups of recent words are cached, up to cache_size of them
+  """
+  HEADER = struct.Struct('<4sHHqq')
+  MAGIC = b'TDSI'
+  VERSION = 1
+
+  def __init__(self, path, cache_size=DICT_SUB_CACHE_SIZE):
+    self.path = path
+    self.cache_size = cache_size
+    with open(path, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(self._mm)
+    magic, version, _, n, n_labels = self.HEADER.unpack_from(buf)
+    if magic != self.MAGIC or version != self.VERSION:
+      raise ValueError("%s is not a dict sub index of version %d" % (path, self.VERSION))
+    self._n = n
+    off = self.HEADER.size
+    self._hashes = buf[off:off + 8*n].cast('Q')
+    off += 8*n
+    self._key_offs = buf[off:off + 8*(n+1)].cast('Q')
+    off += 8*(n+1)
+    label_offs = buf[off:off + 8*(n_labels+1)].cast('Q')
+    off += 8*(n_labels+1)
+    self._label_ids = buf[off:off + 4*n].cast('I')
+    off += 4*n
+    self._keys = buf[off:off + self._key_offs[n]]
+    off += self._key_offs[n]
+
+    # There are few distinct labels, so they are decoded up front
+    labels = bytes(buf[off:off + label_offs[n_labels]])
+    self.labels = [labels[label_offs[i]:label_offs[i+1]].decode('utf-8') for i in range(n_labels)]
+    self._lookup = lru_cache(maxsize=cache_size)(self._find)
+
+  def _find(self, word):
+    key = word.encode('utf-8')
+    h = _key_hash(key)
+    i = bisect_left(self._hashes, h)
+    while i < self._n and self._hashes[i] == h:
+      if self._keys[self._key_offs[i]:self._key_offs[i+1]] == key:
+        return self.labels[self._label_ids[i]]
+      i += 1
+    return None
+
+  def get(self, word, default=None):
+    label = self._lookup(word)
+    return default if label is None else label
+
+  def __getitem__(self, word):
+    label = self._lookup(word)
+    if label is None:
+      raise KeyError(word)
+    return label
+
+  def __contains__(self, word):
+    return self._lookup(word) is not None
+
+  def __len__(self):
+    return self._n
+
+  def __iter__(self):
+    """Iterate over the words, in index (i.e. hash) order"""
+    for i in range(self._n):
+      yield bytes(self._keys[self._key_offs[i]:self._key_offs[i+1]]).decode('utf-8')
+
+  def items(self):
+    for i, word in enumerate(self):
+      yield word, self.labels[self._label_ids[i]]
+
+  def __reduce__(self):
+    # Pickled by path, e.g. for passing to worker processes, which then map the same file
+    return (self.__class__, (self.path, self.cache_size))
+
+  def __repr__(self):
+    return '<%s %s: %d words, %d labels>' % (self.__class__.__name__, self.path, len(self), len(self.labels))
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Build a memory-mapped dictionary substitution index")
+  parser.add_argument('path', help="Path of the index file to write")
+  parser.add_argument('--clusters', default=None, help="TSV file of (word, brown cluster id) lines")
+  parser.add_argument('--dict', action='append', default=[], help="NAME=path dictionary file, one word per line; these take priority over the clusters")
+  args = parser.parse_args(argv)
+
+  user_dicts = []
+  for d in args.dict:
+    name, path = d.split('=', 1)
+    with open(path) as f:
+      user_dicts.append((name, [line.strip() for line in f if len(line.strip()) > 0]))
+  build_dict_sub_index(args.path, brown_clusters_path=args.clusters, user_dicts=user_dicts)
+  print(DictSubIndex(args.path))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,322 @@
+r"""
+Dependency path regex search over a corpus, for distant supervision rule (DSR) search
+Each candidate's dependency tree is re-rooted at its first mention & flattened to a string (see
+flat_tree, and dsr/DSR_search.ipynb), so that rules can be written as regexes over paths, e.g.
+r'\[M0\] \( (?:\S+ )*--nsubj--> \S+\[M1\]'. The flattened trees of a whole corpus are built once
+into an on-disk index, along with an inverted index of their character n-grams; a query then
+only runs its regex over the paths which contain the n-grams any match of it must (see
+templates.regex_keys), rather than re-parsing & re-flattening every tree.
+
+Example:
+  treedlib-dsr build paths.idx --fields ... --id relation_id --mentions m1,m2 < input.tsv
+  treedlib-dsr search paths.idx '\[M0\] \( --dobj--> \S+\[M1\]'
+"""
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+from itertools import product
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import string
+import struct
+import sys
+from treedlib.paths import tree_paths
+from treedlib.templates import RGX_GRAM, key_cost, regex_keys
+
+
+def flat_tree(root, cids, cid_attrib='word_idx', attrib='word', label_attrib='dep_label'):
+  """
+  Flatten the tree root belongs to, re-rooted at the (highest) node of mention 0, to a string:
+  each node is its attrib value (or ROOT, for the attribute-less document root), tagged [Mk]
+  if in mention k, followed by its neighbors other than the one it was reached from (i.e. its
+  children, then its parent) as ' ( x, y )'. Each neighbor is preceded by its edge: --label-->
+  down to a child, or <--label-- up to a parent, with the dependency label of the child
+  Returns None if mention 0 is not in the tree
+  """
+  tp = tree_paths(root)
+  tags = {}
+  for k, cid in enumerate(cids):
+    for i in tp.find(cid_attrib, cid):
+      tags[i] = tags.get(i, '') + '[M%d]' % k
+  m0 = tp.find(cid_attrib, cids[0]) if len(cids) > 0 else []
+  if len(m0) == 0:
+    return None
+  start = min(m0, key=lambda i : tp.depths[i])
+
+  def token(i):
+    v = tp.get(i, attrib)
+    return ('ROOT' if v is None and tp.parents[i] < 0 else str(v)) + tags.get(i, '')
+
+  def label(i):
+    v = tp.get(i, label_attrib)
+    return '' if v is None else v
+
+  # Iterative depth-first walk, where the stack holds (node, node reached from, prefix) triples
+  # & the closing parentheses
+  out = []
+  stack = [(start, -1, '')]
+  while len(stack) > 0:
+    item = stack.pop()
+    if isinstance(item, str):
+      out.append(item)
+      continue
+    i, src, prefix = item
+    out.append(prefix + token(i))
+    nbrs = [(c, '--%s--> ' % label(c)) for c in tp.children(i) if c != src]
+    p = tp.parents[i]
+    if p >= 0 and p != src:
+      nbrs.append((p, '<--%s-- ' % label(i)))
+    if len(nbrs) > 0:
+      stack.append(' )')
+      for k in range(len(nbrs) - 1, -1, -1):
+        stack.append((nbrs[k][0], i, (', ' if k > 0 else ' ( ') + nbrs[k][1]))
+  return ''.join(out)
+
+
+def _gram_hash(g):
+  return int.from_bytes(hashlib.blake2b(g.encode('utf-8'), digest_size=8).digest(), 'little')
+
+@lru_cache(maxsize=None)
+def _ascii_folds():
+  """Get ascii letter -> the chars matching it in a case-insensitive regex (e.g. U+212A for k)"""
+  folds = dict((c, {c, c.upper()}) for c in string.ascii_lowercase)
+  others = re.findall('(?i)[a-z]', ''.join(map(chr, range(0x80, sys.maxunicode + 1))))
+  for u in others:
+    for c in folds:
+      if re.fullmatch(c, u, re.IGNORECASE):
+        folds[c].add(u)
+  return dict((c, sorted(us)) for c, us in folds.items())
+
+def _case_variants(g):
+  """Get the strings a lowercased ascii n-gram matches case-insensitively"""
+  folds = _ascii_folds()
+  return [''.join(p) for p in product(*[folds.get(c, [c]) for c in g])]
+
+
+def build_path_index(path, rows, cid_attrib='word_idx', attrib='word', label_attrib='dep_label'):
+  """
+  Build a PathIndex file at path of the flat_tree strings of the candidates in rows, an iterable
+  of (tree, cands) pairs, where cands is a list of (candidate id, cids) for candidates in the
+  tree; returns the number of candidates indexed (those whose mention 0 is not found are not)
+  Note: the n-gram postings are accumulated in memory; the strings are streamed to disk
+  """
+  postings = {}
+  text_offs, id_offs = array('Q', [0]), array('Q', [0])
+  ids = bytearray()
+  with open(path + '.texts.tmp', 'wb') as texts:
+    for root, cands in rows:
+      for cand_id, cids in cands:
+        s = flat_tree(root, cids, cid_attrib, attrib, label_attrib)
+        if s is None:
+          continue
+        r = len(text_offs) - 1
+        for g in set(s[i:i+RGX_GRAM] for i in range(len(s) - RGX_GRAM + 1)):
+          p = postings.get(g)
+          if p is None:
+            p = postings[g] = array('I')
+          p.append(r)
+        b = s.encode('utf-8')
+        texts.write(b)
+        text_offs.append(text_offs[-1] + len(b))
+        ids += str(cand_id).encode('utf-8')
+        id_offs.append(len(ids))
+
+  # Note: records are added in order, so each postings list is already sorted
+  grams = sorted((_gram_hash(g), p) for g, p in postings.items())
+  post_offs = array('Q', [0])
+  for _, p in grams:
+    post_offs.append(post_offs[-1] + len(p))
+  meta = json.dumps({'cid_attrib' : cid_attrib, 'attrib' : attrib, 'label_attrib' : label_attrib}).encode('utf-8')
+  n = len(text_offs) - 1
+  with open(path + '.tmp', 'wb') as f:
+    f.write(PathIndex.HEADER.pack(PathIndex.MAGIC, PathIndex.VERSION, RGX_GRAM, n, len(grams), post_offs[-1], len(meta)))
+    for a in (text_offs, id_offs, array('Q', [h for h, _ in grams]), post_offs):
+      f.write(a.tobytes())
+    for _, p in grams:
+      f.write(p.tobytes())
+    f.write(meta)
+    f.write(ids)
+    with open(path + '.texts.tmp', 'rb') as texts:
+      shutil.copyfileobj(texts, f)
+  os.remove(path + '.texts.tmp')
+  os.replace(path + '.tmp', path)
+  return n
+
+
+class PathIndex:
+  """
+  A read-only, memory-mapped index of flattened candidate trees, written by build_path_index
+  Layout: the header, the uint64 path & candidate id offsets, the sorted uint64 n-gram hashes &
+  their postings offsets, the uint32 postings (record ids), then the meta, id & path blobs
+  """
+  HEADER = struct.Struct('<4sHHqqqq')
+  MAGIC = b'TDPI'
+  VERSION = 1
+
+  # Max ratio of the postings of a key to the records left, for it to be worth intersecting
+  INTERSECT_RATIO = 8
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(self._mm)
+    magic, version, gram, n, n_grams, n_postings, meta_len = self.HEADER.unpack_from(buf)
+    if magic != self.MAGIC or version != self.VERSION:
+      raise ValueError("%s is not a path index of version %d" % (path, self.VERSION))
+    if gram != RGX_GRAM:
+      raise ValueError("%s was built with %d-grams, not %d-grams" % (path, gram, RGX_GRAM))
+    self._n = n
+    off = self.HEADER.size
+    def read(k, fmt, size):
+      nonlocal off
+      a = buf[off:off + size*k].cast(fmt)
+      off += size*k
+      return a
+    self._text_offs = read(n + 1, 'Q', 8)
+    self._id_offs = read(n + 1, 'Q', 8)
+    self._gram_hashes = read(n_grams, 'Q', 8)
+    self._post_offs = read(n_grams + 1, 'Q', 8)
+    self._postings = read(n_postings, 'I', 4)
+    self.meta = json.loads(bytes(buf[off:off + meta_len]).decode('utf-8'))
+    off += meta_len
+    self._ids = buf[off:off + self._id_offs[n]]
+    self._texts = buf[off + self._id_offs[n]:]
+
+  def __len__(self):
+    return self._n
+
+  def candidate_id(self, r):
+    return bytes(self._ids[self._id_offs[r]:self._id_offs[r+1]]).decode('utf-8')
+
+  def flat_tree(self, r):
+    return bytes(self._texts[self._text_offs[r]:self._text_offs[r+1]]).decode('utf-8')
+
+  def __getitem__(self, r):
+    """Get the (candidate id, flattened tree) of record r"""
+    return self.candidate_id(r), self.flat_tree(r)
+
+  def postings(self, g):
+    """Get the sorted ids of the records containing n-gram g"""
+    h = _gram_hash(g)
+    k = bisect_left(self._gram_hashes, h)
+    if k < len(self._gram_hashes) and self._gram_hashes[k] == h:
+      return self._postings[self._post_offs[k]:self._post_offs[k+1]]
+    return self._postings[0:0]
+
+  def candidates(self, rgx):
+    """
+    Get the sorted ids of the records which may match compiled regex rgx, i.e. which contain at
+    least one n-gram of each of its keys (see templates.regex_keys)
+    """
+    expand = _case_variants if rgx.flags & re.IGNORECASE else (lambda g : [g])
+    posts = {}
+    def postings(g):
+      if g not in posts:
+        posts[g] = [p for p in (self.postings(v) for v in expand(g)) if len(p) > 0]
+      return posts[g]
+    cost = lambda g : sum(len(p) for p in postings(g))
+    keys = sorted(regex_keys(rgx, cost), key=lambda k : key_cost(k, cost))
+    if len(keys) == 0 or key_cost(keys[0], cost)[0] >= len(self):
+      return range(len(self))
+
+    # Intersect the records of the keys, cheapest first, while this is cheaper than just
+    # running the regex over the records left
+    res = None
+    for key in keys:
+      if res is not None and key_cost(key, cost)[0] > self.INTERSECT_RATIO * len(res):
+        break
+      rs = set()
+      for g in key:
+        for p in postings(g):
+          rs.update(p)
+      res = rs if res is None else res & rs
+      if len(res) == 0:
+        break
+    return sorted(res)
+
+  def search(self, rgx, flags=0, limit=None):
+    """Yield the (candidate id, flattened tree, match) of the records which match regex rgx"""
+    rgx = re.compile(rgx, flags) if isinstance(rgx, str) else rgx
+    n = 0
+    for r in self.candidates(rgx):
+      s = self.flat_tree(r)
+      m = rgx.search(s)
+      if m is not None:
+        yield self.candidate_id(r), s, m
+        n += 1
+        if limit is not None and n >= limit:
+          return
+
+  def __repr__(self):
+    return '<%s %s: %d paths>' % (self.__class__.__name__, self.path, len(self))
+
+
+def read_candidate_rows(lines, fields, id_field, mention_fields):
+  """
+  Read PTSV candidate rows (as for treedlib.parallel) into (tree, cands) pairs, where rows with
+  the same sentence columns in a row share one (Array)tree
+  """
+  from treedlib.util import PTSVParser, compile_ptsv_parser, print_error
+  from treedlib.structs import corenlp_to_arraytree
+  names = [f[0] for f in fields]
+  parser = PTSVParser(fields)
+  id_idx, id_parse = names.index(id_field), compile_ptsv_parser(fields[names.index(id_field)][1])
+  mentions = [(names.index(m), compile_ptsv_parser(fields[names.index(m)][1])) for m in mention_fields]
+  sentence_idxs = [i for i, name in enumerate(names) if name != id_field and name not in mention_fields]
+  key, tree, cands = None, None, []
+  for line in lines:
+    if len(line.strip()) == 0:
+      continue
+    attribs = line.rstrip('\n').split('\t')
+    try:
+      k = tuple(attribs[i] for i in sentence_idxs)
+      if k != key:
+        if len(cands) > 0:
+          yield tree, cands
+        key, cands = None, []
+        tree = corenlp_to_arraytree(parser.parse_line(line))
+        key = k
+      cands.append((id_parse(attribs[id_idx]), [parse(attribs[i]) for i, parse in mentions]))
+    except Exception as e:
+      print_error(str(e))
+  if len(cands) > 0:
+    yield tree, cands
+
+
+def main(argv=None):
+  from treedlib.parallel import parse_fields
+  parser = argparse.ArgumentParser(description="Dependency path regex search (DSR) index")
+  sub = parser.add_subparsers(dest='cmd')
+  sub.required = True
+  build = sub.add_parser('build', help="Build an index from PTSV candidate rows on stdin")
+  build.add_argument('path', help="Path of the index file to write")
+  build.add_argument('--fields', required=True, help="Input fields, as name:type,name:type,...")
+  build.add_argument('--id', required=True, help="Field identifying each candidate")
+  build.add_argument('--mentions', required=True, help="Comma-separated mention word index fields")
+  build.add_argument('--attrib', default='word', help="Node attribute to flatten the trees with")
+  search = sub.add_parser('search', help="Write the (candidate id, flattened tree) of each match as TSV")
+  search.add_argument('path', help="Path of the index file")
+  search.add_argument('regex')
+  search.add_argument('-i', '--ignore-case', action='store_true')
+  search.add_argument('--limit', type=int, default=None)
+  args = parser.parse_args(argv)
+
+  if args.cmd == 'build':
+    rows = read_candidate_rows(sys.stdin, parse_fields(args.fields), args.id, args.mentions.split(','))
+    n = build_path_index(args.path, rows, attrib=args.attrib)
+    sys.stderr.write('Indexed %d candidates\n' % n)
+  else:
+    index = PathIndex(args.path)
+    flags = re.IGNORECASE if args.ignore_case else 0
+    for cand_id, s, _ in index.search(args.regex, flags=flags, limit=args.limit):
+      sys.stdout.write('%s\t%s\n' % (cand_id, s))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,7 +1,7 @@
 from treedlib.templates import *
 import lxml.etree as et
 
-def compile_relation_feature_generator(dictionaries=None, opts={}, is_multary=False):
+def compile_relation_feature_generator(dictionaries=None, opts={}, is_multary=False, is_batch=False, profile=False, hasher=None):
   """
   Given optional arguments, returns a generator function which accepts an xml root
   and two lists of mention indexes, and will generate relation features for this relation
@@ -10,6 +10,24 @@ def compile_relation_feature_generator(dictionaries=None, opts={}, is_multary=Fa
     * dictionaries: should be a dictionary of lists of phrases, where the key is the dict name
     * opts: see defaults above
     * is_multary: whether to use multiple mentions or binary mentions
+    * is_batch: whether to instead accept a *list* of relations in the same sentence, and
+      generate (relation index, feature) pairs
+    * profile: whether to collect per-template profiling stats, in the Profiler of the Compile
+      object the generator is bound to, i.e. gen.__self__.profiler
+    * hasher: optional function mapping feature strings to integer ids, e.g. a FeatureHasher
+  """
+  templates = relation_feature_templates(dictionaries=dictionaries, opts=opts)
+
+  # return generator function
+  c = Compile(templates, profile=profile, hasher=hasher)
+  if is_multary:
+    return c.apply_multary_relations if is_batch else c.apply_multary_relation
+  return c.apply_relations if is_batch else c.apply_relation
+
+def relation_feature_templates(dictionaries=None, opts={}):
+  """
+  Get the list of relation feature templates used by compile_relation_feature_generator, e.g.
+  for use with IncrementalCompile
   """
   # TODO: put globals into opts
   #BASIC_ATTRIBS_REL = ['word', 'lemma', 'pos', 'ner', 'dep_label']
@@ -63,13 +81,10 @@ def compile_relation_feature_generator(dictionaries=None, opts={}, is_multary=Fa
   # Add dictionary features
   if dictionaries:
     for d_name, d in dictionaries.items():
-      templates.append(DictionaryIntersect(btwn, d_name, d))
-      templates.append(DictionaryIntersect(SeqBetween(), d_name, d))
-
-  # return generator function
-  if is_multary:
-    return Compile(templates).apply_multary_relation
-  return Compile(templates).apply_relation
+      dm = PhraseMatcher(d)
+      templates.append(DictionaryIntersect(btwn, d_name, dm))
+      templates.append(DictionaryIntersect(SeqBetween(), d_name, dm))
+  return templates
 
 """
 For calibrating the bin sizes
@@ -0,0 +1,93 @@
+from hashlib import blake2b
+from treedlib.util import format_tsv, copy_unescape
+
+
+def _tuple_string(feature):
+  """The string form of a (label, ngram tuple) or ngram tuple feature, as output='str' gives it"""
+  if len(feature) == 2 and isinstance(feature[1], tuple):
+    return '%s[%s]' % (feature[0], ' '.join(feature[1]))
+  return ' '.join(feature)
+
+
+class FeatureHasher:
+  """
+  Maps feature strings to integer ids in [0, 2^bits) with a seeded hash; int features (e.g.
+  already hashed ngrams) are just reduced to bits wide, and tuple features (ngrams) get the ids
+  of their string forms. At most 63 bits are allowed, so that ids always fit a (signed) Postgres
+  bigint column
+  Unlike python's builtin hash, ids are stable across processes & runs for a given seed
+  If reversible=True, the features seen are recorded, so that the id -> feature string mapping
+  can be written out on the side (see write_dictionary)
+  """
+  def __init__(self, bits=24, seed=0, reversible=False):
+    if not (type(bits) == int and 0 < bits <= 63):
+      raise ValueError("bits must be an int in [1, 63]")
+    if not (type(seed) == int and 0 <= seed < 2**64):
+      raise ValueError("seed must be an int in [0, 2^64)")
+    self.bits = bits
+    self.seed = seed
+    self.reversible = reversible
+    self.features = {}
+    self._mask = (1 << bits) - 1
+    self._key = seed.to_bytes(8, 'little')
+
+  def hash(self, feature):
+    """Get the id of a feature string, without recording it"""
+    h = blake2b(feature.encode('utf-8'), digest_size=8, key=self._key).digest()
+    return int.from_bytes(h, 'little') & self._mask
+
+  def __call__(self, feature):
+    # Features already hashed to ints (e.g. Ngrams(..., output='hash')) are just reduced to width
+    if type(feature) == int:
+      return feature & self._mask
+    if type(feature) == tuple:
+      feature = _tuple_string(feature)
+    if self.reversible:
+      fid = self.features.get(feature)
+      if fid is None:
+        fid = self.features[feature] = self.hash(feature)
+      return fid
+    return self.hash(feature)
+
+  def pop_features(self):
+    """Get & clear the recorded feature -> id mapping, e.g. to hand back from a worker"""
+    features = self.features
+    self.features = {}
+    return features
+
+  def merge(self, features):
+    """Record a feature -> id mapping, e.g. from another worker's pop_features"""
+    self.features.update(features)
+
+  def dictionary(self):
+    """Get the recorded id -> list of feature strings mapping; lists of > 1 are collisions"""
+    d = {}
+    for f, fid in self.features.items():
+      d.setdefault(fid, []).append(f)
+    for fs in d.values():
+      fs.sort()
+    return d
+
+  def collisions(self):
+    """Get the number of recorded features that collide with another"""
+    return len(self.features) - len(set(self.features.values()))
+
+  def write_dictionary(self, path):
+    """Write the recorded (id, feature string) pairs as TSV, sorted by id"""
+    with open(path, 'w') as f:
+      for fid, fs in sorted(self.dictionary().items()):
+        for feat in fs:
+          f.write(format_tsv((fid, feat)) + '\n')
+
+  @staticmethod
+  def read_dictionary(path):
+    """Read a dictionary written by write_dictionary, as id -> list of feature strings"""
+    d = {}
+    with open(path) as f:
+      for line in f:
+        fid, feat = line.rstrip('\n').split('\t', 1)
+        d.setdefault(int(fid), []).append(copy_unescape(feat))
+    return d
+
+  def __repr__(self):
+    return '<%s bits=%s, seed=%s>' % (self.__class__.__name__, self.bits, self.seed)
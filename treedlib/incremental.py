@@ -0,0 +1,143 @@
+"""
+Incremental feature regeneration
+Each template (i.e. operator of a Compile) gets a stable fingerprint derived from its structure,
+and its outputs are stored in a file of its own. On a re-run with a changed template set, only
+the templates which are new (or changed, and so have a new fingerprint) are computed, and the
+outputs of templates which were removed are dropped.
+"""
+from array import array
+from hashlib import blake2b
+import json
+import os
+import re
+from treedlib.util import format_tsv
+from treedlib.templates import Compile
+
+
+def _canonical(x, h):
+  """Feed a canonical serialization of x into hash h"""
+  if x is None or isinstance(x, (str, bytes, bool, int, float)):
+    h.update(repr(x).encode('utf-8'))
+  elif isinstance(x, (list, tuple, array)):
+    h.update(b'[')
+    for v in x:
+      _canonical(v, h)
+      h.update(b',')
+    h.update(b']')
+  elif isinstance(x, dict):
+    h.update(b'{')
+    for k in sorted(x, key=repr):
+      _canonical(k, h)
+      h.update(b':')
+      _canonical(x[k], h)
+      h.update(b',')
+    h.update(b'}')
+  elif isinstance(x, (set, frozenset)):
+    _canonical(sorted(x, key=repr), h)
+  elif isinstance(x, re.Pattern):
+    _canonical((x.pattern, x.flags), h)
+  elif hasattr(x, '__dict__'):
+    h.update(('%s.%s' % (type(x).__module__, type(x).__qualname__)).encode('utf-8'))
+    _canonical(dict((k, v) for k, v in vars(x).items() if not k.startswith('_')), h)
+  else:
+    h.update(repr(x).encode('utf-8'))
+
+def template_fingerprint(op):
+  """
+  Get a stable fingerprint of a template: a hash of its class & (public) attributes, recursively,
+  so that e.g. changing an Ngrams range or a dictionary changes it, unlike its __repr__
+  """
+  h = blake2b(digest_size=12)
+  _canonical(op, h)
+  return h.hexdigest()
+
+
+class IncrementalCompile:
+  """
+  Generates & stores the features of a set of templates per template, in directory path
+    * corpus_key: optional identifier of the input corpus (e.g. a hash of the input file); if it
+      differs from that of the stored outputs, they are all regenerated
+  """
+  MANIFEST = 'manifest.json'
+
+  def __init__(self, op_list, path, corpus_key=None):
+    self.ops = list(Compile(op_list)._iterops())
+    self.fingerprints = [template_fingerprint(op) for op in self.ops]
+    self.path = path
+    self.corpus_key = corpus_key
+    os.makedirs(path, exist_ok=True)
+    self.manifest = {'corpus_key' : corpus_key, 'templates' : {}}
+    mpath = os.path.join(path, self.MANIFEST)
+    if os.path.exists(mpath):
+      with open(mpath) as f:
+        manifest = json.load(f)
+      if manifest.get('corpus_key') == corpus_key:
+        self.manifest = manifest
+      else:
+        self._drop(manifest['templates'])
+
+  def _output_path(self, fp):
+    return os.path.join(self.path, '%s.tsv' % fp)
+
+  def _save_manifest(self):
+    mpath = os.path.join(self.path, self.MANIFEST)
+    with open(mpath + '.tmp', 'w') as f:
+      json.dump(self.manifest, f, indent=2, sort_keys=True)
+    os.replace(mpath + '.tmp', mpath)
+
+  def _drop(self, fps):
+    for fp in fps:
+      if os.path.exists(self._output_path(fp)):
+        os.remove(self._output_path(fp))
+
+  def stale(self):
+    """Get the (fingerprint, template) pairs whose outputs are not stored"""
+    res = {}
+    for fp, op in zip(self.fingerprints, self.ops):
+      if fp not in self.manifest['templates'] or not os.path.exists(self._output_path(fp)):
+        res[fp] = op
+    return list(res.items())
+
+  def removed(self):
+    """Get the fingerprints of stored outputs of templates no longer in the template set"""
+    return sorted(set(self.manifest['templates']).difference(self.fingerprints))
+
+  def run(self, rows, cid_attrib='word_idx', dict_sub={}, stopwords=None):
+    """
+    Compute the outputs of just the stale templates, and drop those of removed templates
+    rows is an iterable of (tree, cands) pairs, where cands is a list of (candidate id, cids)
+    for candidates in the tree; returns the number of templates computed
+    """
+    removed = self.removed()
+    for fp in removed:
+      del self.manifest['templates'][fp]
+    self._drop(removed)
+    stale = self.stale()
+    if len(stale) > 0:
+      outs = [open(self._output_path(fp) + '.tmp', 'w') for fp, _ in stale]
+      try:
+        for root, cands in rows:
+          memo = {}
+          for cid, cids in cands:
+            for (fp, op), out in zip(stale, outs):
+              for f in op.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords, memo=memo):
+                out.write(format_tsv((cid, f)) + '\n')
+      finally:
+        for out in outs:
+          out.close()
+
+      # Only commit the outputs once complete
+      for fp, op in stale:
+        os.replace(self._output_path(fp) + '.tmp', self._output_path(fp))
+        self.manifest['templates'][fp] = repr(op)
+    self._save_manifest()
+    return len(stale)
+
+  def outputs(self):
+    """Yield the stored output lines of all the current templates"""
+    for fp in self.fingerprints:
+      if fp not in self.manifest['templates']:
+        raise ValueError("Outputs of %s are not stored; call run first" % self.ops[self.fingerprints.index(fp)])
+      with open(self._output_path(fp)) as f:
+        for line in f:
+          yield line.rstrip('\n')
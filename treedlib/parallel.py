@@ -0,0 +1,300 @@
+"""
+Parallel feature extraction driver
+Reads PTSV candidate rows (sentence columns + candidate mention index columns), spreads tree
+building & feature generation across a pool of worker processes in chunks, and writes TSV
+(candidate id, feature) output. Each worker loads the templates & dictionaries just once, and
+formats its own output rows, which are then written in large blocks (see treedlib.writers).
+
+Example:
+  python -m treedlib.parallel \\
+    --fields relation_id:text,words:text[],lemmas:text[],poses:text[],dep_labels:text[],dep_parents:int[],m1:int[],m2:int[] \\
+    --id relation_id --mentions m1,m2 --dict GENE=genes.txt -p 32 < input.tsv > features.tsv
+
+  Add e.g. `-o features.bin --binary --shards 8` for 8 binary COPY files to load in parallel
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import os
+import sys
+from treedlib.util import PTSVParser, compile_ptsv_parser, format_tsv, print_error
+from treedlib.writers import CopyWriter, ShardedCopyWriter, compile_binary_row_encoder
+from treedlib.structs import corenlp_to_xmltree, corenlp_to_arraytree, ArrayTree
+from treedlib.cache import TreeCache
+from treedlib.dictsub import DictSubIndex
+from treedlib.features import compile_relation_feature_generator
+from treedlib.profiling import Profiler
+from treedlib.hashing import FeatureHasher
+
+
+def load_dictionary(path):
+  """Load a dictionary file of one phrase per line"""
+  with open(path) as f:
+    return [line.strip() for line in f if len(line.strip()) > 0]
+
+def relation_feature_generator(dict_paths={}, profile=False, hash_bits=None, hash_seed=0, hash_dict=False):
+  """
+  The default worker generator factory: the compile_relation_feature_generator features
+  Generator factories must return a *batch* generator, i.e. a function which accepts a tree and
+  a list of candidates (each a list of mention index lists), and generates (index, feature) pairs
+  If the generator is a bound Compile method with a profiler, per-chunk profiles are collected,
+  and with a reversible hasher, the per-chunk feature id dictionaries
+  """
+  dictionaries = dict((d_name, load_dictionary(path)) for d_name, path in dict_paths.items())
+  hasher = FeatureHasher(hash_bits, hash_seed, reversible=hash_dict) if hash_bits else None
+  return compile_relation_feature_generator(dictionaries=dictionaries or None, is_multary=True, is_batch=True,
+                                            profile=profile, hasher=hasher)
+
+
+# State of each worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(fields, id_field, mention_fields, factory, factory_kwargs, arraytree, tree_cache=None, dict_sub=None,
+                 binary_types=None, shard_keys=False):
+  names = [f[0] for f in fields]
+  _worker['parser'] = PTSVParser(fields)
+  _worker['id'] = (names.index(id_field), compile_ptsv_parser(fields[names.index(id_field)][1]))
+  _worker['mentions'] = [(names.index(m), compile_ptsv_parser(fields[names.index(m)][1])) for m in mention_fields]
+  _worker['sentence_idxs'] = [i for i,name in enumerate(names) if name != id_field and name not in mention_fields]
+  _worker['generator'] = factory(**factory_kwargs)
+  _worker['profiler'] = getattr(getattr(_worker['generator'], '__self__', None), 'profiler', None)
+  _worker['hasher'] = getattr(getattr(_worker['generator'], '__self__', None), 'hasher', None)
+  _worker['to_tree'] = corenlp_to_arraytree if arraytree else lambda s : corenlp_to_xmltree(s).root
+  _worker['arraytree'] = arraytree
+  _worker['cache'] = TreeCache(tree_cache) if tree_cache else None
+  _worker['kwargs'] = {'dict_sub' : DictSubIndex(dict_sub)} if dict_sub else {}
+  _worker['format'] = compile_binary_row_encoder(binary_types) if binary_types else format_tsv
+  _worker['shard_keys'] = shard_keys
+  _worker['schema'] = ','.join('%s:%s' % tuple(fields[i]) for i in _worker['sentence_idxs'])
+
+def _sentence_input(k, line):
+  """
+  Get the input for _extract_sentence for a line with raw sentence columns k: with a tree
+  cache, this is the ArrayTree, from the cache if possible; otherwise the parsed row
+  """
+  cache = _worker['cache']
+  if cache is None:
+    return _worker['parser'].parse_line(line)
+  return cache.tree((_worker['schema'],) + k, lambda : corenlp_to_arraytree(_worker['parser'].parse_line(line)))
+
+def _emit(records, out, keys):
+  """Format output records (id, feature) into out, & add their ids to keys if it is a list"""
+  fmt = _worker['format']
+  out.extend([fmt(r) for r in records])
+  if keys is not None:
+    keys.extend([r[0] for r in records])
+
+def _extract_sentence(tree_input, cands, out, errs, keys=None):
+  """
+  Generate the features for a batch of candidates in the same sentence
+  If the batch fails, its candidates are retried one at a time, so that only the ones which
+  fail are dropped (& reported, by id)
+  """
+  ids, cids = zip(*cands)
+  try:
+    if isinstance(tree_input, ArrayTree):
+      tree = tree_input if _worker['arraytree'] else tree_input.to_xmltree().root
+    else:
+      tree = _worker['to_tree'](tree_input)
+  except Exception as e:
+    errs.append("%s: %s" % (', '.join(map(str, ids)), e))
+    return
+  generator, kwargs = _worker['generator'], _worker['kwargs']
+  try:
+    _emit([(ids[k], f) for k, f in generator(tree, list(cids), **kwargs)], out, keys)
+    return
+  except Exception as e:
+    if len(cands) == 1:
+      errs.append("%s: %s" % (ids[0], e))
+      return
+  for cid, c in cands:
+    try:
+      _emit([(cid, f) for _, f in generator(tree, [c], **kwargs)], out, keys)
+    except Exception as e:
+      errs.append("%s: %s" % (cid, e))
+
+def _extract_chunk(lines):
+  """
+  Process a chunk of input lines, returning (output rows, error messages, side info dict)
+  Consecutive rows with the same sentence columns share a single tree & batched generator call
+  """
+  out, errs = [], []
+  keys = [] if _worker['shard_keys'] else None
+  key, tree_input, cands = None, None, []
+  for line in lines:
+    attribs = line.rstrip('\n').split('\t')
+    cid = None
+    try:
+      cid = _worker['id'][1](attribs[_worker['id'][0]])
+      k = tuple(attribs[i] for i in _worker['sentence_idxs'])
+      if k != key:
+        if len(cands) > 0:
+          _extract_sentence(tree_input, cands, out, errs, keys)
+        key, cands = k, []
+        try:
+          tree_input = _sentence_input(k, line)
+        except Exception as e:
+          tree_input = e
+
+      # If the sentence can't be parsed, each of its candidates is dropped & reported by id
+      if isinstance(tree_input, Exception):
+        errs.append("%s: %s" % (cid, tree_input))
+        continue
+      cands.append((cid, [parse(attribs[i]) for i,parse in _worker['mentions']]))
+    except Exception as e:
+      errs.append(str(e) if cid is None else "%s: %s" % (cid, e))
+  if len(cands) > 0:
+    _extract_sentence(tree_input, cands, out, errs, keys)
+
+  # Hand back the profile & new feature ids for just this chunk, to be merged in the main process
+  side = {}
+  if keys is not None:
+    side['keys'] = keys
+  prof = _worker['profiler']
+  if prof is not None:
+    side['profile'] = prof.to_dict()
+    prof.reset()
+  hasher = _worker['hasher']
+  if hasher is not None and getattr(hasher, 'reversible', False):
+    side['feature_ids'] = hasher.pop_features()
+  return out, errs, side
+
+def _chunks(lines, chunk_size):
+  chunk = []
+  for line in lines:
+    if len(line.strip()) > 0:
+      chunk.append(line)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if len(chunk) > 0:
+    yield chunk
+
+
+def extract_parallel(lines, fields, id_field, mention_fields, processes=None, chunk_size=500,
+                     ordered=True, max_in_flight=None, factory=relation_feature_generator,
+                     factory_kwargs={}, arraytree=True, tree_cache=None, dict_sub=None, binary_types=None,
+                     shard_keys=False):
+  """
+  Extract features from an iterable of PTSV candidate rows across a pool of processes
+    * fields: list of (field_name, field_type) tuples, as for PTSVParser
+    * id_field: the field identifying each candidate in the output
+    * mention_fields: the int[] fields holding each mention's word indexes
+    * processes: number of worker processes; if 0, run serially in this process
+    * ordered: whether to keep output chunks in input order
+    * max_in_flight: max number of chunks submitted but not yet written (default 2x processes)
+    * factory, factory_kwargs: picklable function building the batch generator in each worker
+    * tree_cache: optional TreeCache directory, to load trees from & save new trees to
+    * dict_sub: optional DictSubIndex file, which each worker maps & passes to the generator
+    * binary_types: optional (id, feature) column types, to output binary COPY rows rather
+      than TSV lines (see CopyWriter)
+    * shard_keys: whether to also return the id of each output row, for sharding the output
+      (see ShardedCopyWriter.write_formatted)
+  Yields (output rows, error messages, side info dict) per chunk, where the side info dict
+  optionally has a 'profile' (see Profiler.merge), new 'feature_ids' (see FeatureHasher.merge)
+  and the row ids, as 'keys'
+  """
+  init_args = (fields, id_field, mention_fields, factory, factory_kwargs, arraytree, tree_cache, dict_sub, binary_types,
+               shard_keys)
+  if processes == 0:
+    _init_worker(*init_args)
+    for chunk in _chunks(lines, chunk_size):
+      yield _extract_chunk(chunk)
+    return
+
+  processes = processes or os.cpu_count() or 1
+  max_in_flight = max_in_flight or 2 * processes
+  with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=init_args) as pool:
+    in_flight = deque() if ordered else set()
+    for chunk in _chunks(lines, chunk_size):
+
+      # Bound the memory in flight by waiting for chunks to finish before submitting more
+      while len(in_flight) >= max_in_flight:
+        if ordered:
+          yield in_flight.popleft().result()
+        else:
+          done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+          for fut in done:
+            yield fut.result()
+      fut = pool.submit(_extract_chunk, chunk)
+      if ordered:
+        in_flight.append(fut)
+      else:
+        in_flight.add(fut)
+
+    # Flush the remaining chunks
+    while len(in_flight) > 0:
+      if ordered:
+        yield in_flight.popleft().result()
+      else:
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for fut in done:
+          yield fut.result()
+
+
+def parse_fields(s):
+  """Parse a field spec string of the form name:type,name:type,..."""
+  return [tuple(f.strip().split(':')) for f in s.split(',')]
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Parallel treedlib feature extraction: PTSV rows on stdin, TSV (id, feature) on stdout")
+  parser.add_argument('--fields', required=True, help="Input fields, as name:type,name:type,...")
+  parser.add_argument('--id', required=True, help="Field identifying each candidate")
+  parser.add_argument('--mentions', required=True, help="Comma-separated mention word index fields")
+  parser.add_argument('--dict', action='append', default=[], help="NAME=path dictionary file, one phrase per line")
+  parser.add_argument('-p', '--processes', type=int, default=None, help="Number of worker processes (default: # of cpus)")
+  parser.add_argument('--chunk-size', type=int, default=500)
+  parser.add_argument('--max-in-flight', type=int, default=None)
+  parser.add_argument('--unordered', action='store_true', help="Write output chunks as soon as they are done")
+  parser.add_argument('--xmltree', action='store_true', help="Use lxml trees rather than ArrayTrees")
+  parser.add_argument('--tree-cache', default=None, help="Directory of a persistent tree cache to use")
+  parser.add_argument('--dict-sub', default=None, help="Dictionary substitution index file (see treedlib.dictsub) to apply to word/lemma features")
+  parser.add_argument('--profile', default=None, help="Profile the templates, writing the merged profile dump to this path & a report to stderr")
+  parser.add_argument('--hash-bits', type=int, default=None, help="Output hashed integer feature ids of this many bits (at most 63)")
+  parser.add_argument('--hash-seed', type=int, default=0)
+  parser.add_argument('--hash-dict', default=None, help="Write the (feature id, feature) dictionary to this path")
+  parser.add_argument('-o', '--output', default=None, help="Output file (default: stdout)")
+  parser.add_argument('--shards', type=int, default=1, help="Shard the output across this many files, named after --output")
+  parser.add_argument('--binary', action='store_true', help="Output binary COPY format, with columns (id type, text or with --hash-bits bigint)")
+  args = parser.parse_args(argv)
+  if args.shards > 1 and args.output is None:
+    parser.error("--shards needs --output")
+  if args.hash_bits is not None and not 0 < args.hash_bits <= 63:
+    parser.error("--hash-bits must be in [1, 63]")
+
+  dict_paths = dict(d.split('=', 1) for d in args.dict)
+  fields = parse_fields(args.fields)
+  types = [dict(fields)[args.id], 'bigint' if args.hash_bits else 'text']
+  res = extract_parallel(sys.stdin, fields, args.id, args.mentions.split(','),
+                         processes=args.processes, chunk_size=args.chunk_size, ordered=not args.unordered,
+                         max_in_flight=args.max_in_flight,
+                         factory_kwargs={'dict_paths': dict_paths, 'profile': args.profile is not None,
+                                         'hash_bits': args.hash_bits, 'hash_seed': args.hash_seed,
+                                         'hash_dict': args.hash_dict is not None},
+                         arraytree=not args.xmltree, tree_cache=args.tree_cache, dict_sub=args.dict_sub,
+                         binary_types=types if args.binary else None, shard_keys=args.shards > 1)
+  profiler = Profiler()
+  hasher = FeatureHasher(args.hash_bits, args.hash_seed, reversible=True) if args.hash_bits else None
+  if args.shards > 1:
+    writer = ShardedCopyWriter(args.output, args.shards, shard_by=0, types=types, binary=args.binary)
+  else:
+    writer = CopyWriter(sys.stdout if args.output is None else args.output, types=types, binary=args.binary)
+  with writer:
+    for out, errs, side in res:
+      for err in errs:
+        print_error(err)
+      if len(out) > 0:
+        writer.write_formatted(out, side.get('keys'))
+      if 'profile' in side:
+        profiler.merge(side['profile'])
+      if 'feature_ids' in side:
+        hasher.merge(side['feature_ids'])
+  if args.profile is not None:
+    profiler.dump(args.profile)
+    sys.stderr.write(profiler.report() + '\n')
+  if args.hash_dict is not None and hasher is not None:
+    hasher.write_dictionary(args.hash_dict)
+
+
+if __name__ == '__main__':
+  main()
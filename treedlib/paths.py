@@ -0,0 +1,201 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import threading
+
+
+class TreePaths:
+  """
+  Precomputed parent pointers, depths and preorder (i.e. document order) indexing over the
+  nodes of a tree, for fast lowest-common-ancestor & path queries in pure python
+  ---------------
+  Nodes are referred to by their integer preorder index; for lxml trees self.nodes maps back
+  to the elements. Note: the index covers the *whole document* the root belongs to, as xpath
+  queries do- so it is empty if the document has no root element (e.g. root was removed from it)
+  """
+  def __init__(self, root):
+    self.root = root.getroottree().getroot()
+    self.nodes = []
+    parents = []
+
+    # Iterative preorder walk
+    stack = [(self.root, -1)] if self.root is not None else []
+    while len(stack) > 0:
+      node, p = stack.pop()
+      i = len(self.nodes)
+      self.nodes.append(node)
+      parents.append(p)
+      stack.extend((c, i) for c in reversed(node) if isinstance(c.tag, str))
+    self._index(parents)
+
+  def _index(self, parents):
+    """Compute depths, children offsets & subtree intervals from a preorder parent array"""
+    n = len(parents)
+    self.parents = array('i', parents)
+    self.depths = array('i', [0]) * n
+    self.sib_idx = array('i', [0]) * n
+    self.child_offsets = array('i', [0]) * (n + 1)
+    for i in range(1, n):
+      self.depths[i] = self.depths[parents[i]] + 1
+      self.child_offsets[parents[i] + 1] += 1
+    for i in range(n):
+      self.child_offsets[i + 1] += self.child_offsets[i]
+
+    # Children of i are child_idx[child_offsets[i]:child_offsets[i+1]], in document order
+    self.child_idx = array('i', [0]) * max(0, n - 1)
+    fill = self.child_offsets[:-1]
+    for i in range(1, n):
+      p = parents[i]
+      self.sib_idx[i] = fill[p] - self.child_offsets[p]
+      self.child_idx[fill[p]] = i
+      fill[p] += 1
+
+    # Subtree of i is the preorder interval [i, ends[i])
+    self.ends = array('i', range(1, n + 1))
+    for i in range(n - 1, 0, -1):
+      p = parents[i]
+      if self.ends[i] > self.ends[p]:
+        self.ends[p] = self.ends[i]
+    self._attrib_idx = {}
+    self._seq_idx = {}
+    self._values = {}
+
+  def __len__(self):
+    return len(self.parents)
+
+  def get(self, i, attrib):
+    """Get attribute attrib of node i, or None if not present"""
+    return self.nodes[i].get(attrib)
+
+  def values(self, attrib):
+    """Get attribute attrib of all the nodes, as of when it was first asked for (i.e. indexed)"""
+    vs = self._values.get(attrib)
+    if vs is None:
+      vs = self._values[attrib] = [self.get(i, attrib) for i in range(len(self))]
+    return vs
+
+  def is_current(self):
+    """
+    Whether the (lxml) document still has the same nodes, and the same values of the indexed
+    attributes, as the index was built from- i.e. whether it can be reused
+    """
+    if self.root is None or self.nodes != list(self.root.iter('*')):
+      return False
+    return all([n.get(a) for n in self.nodes] == vs for a, vs in self._values.items())
+
+  def xml_elements(self):
+    """Get the lxml elements of the nodes, in node order"""
+    return self.nodes
+
+  def children(self, i):
+    """Get the children of node i, in document order"""
+    return self.child_idx[self.child_offsets[i]:self.child_offsets[i+1]].tolist()
+
+  def siblings(self, i):
+    """Get the children of the parent of node i (including i), in document order"""
+    p = self.parents[i]
+    return self.children(p) if p >= 0 else [i]
+
+  def ancestors(self, i):
+    """Yield the (strict) ancestors of node i, nearest first"""
+    i = self.parents[i]
+    while i >= 0:
+      yield i
+      i = self.parents[i]
+
+  def is_ancestor_or_self(self, a, i):
+    """Whether node a is an ancestor of, or is, node i"""
+    return a <= i < self.ends[a]
+
+  def lca(self, i, j):
+    """Get the lowest common ancestor of nodes i and j"""
+    while self.depths[i] > self.depths[j]:
+      i = self.parents[i]
+    while self.depths[j] > self.depths[i]:
+      j = self.parents[j]
+    while i != j:
+      i = self.parents[i]
+      j = self.parents[j]
+    return i
+
+  def path(self, i, j):
+    """Get the path of nodes from i up to lca(i,j) and back down to j, in dependency order"""
+    a = self.lca(i, j)
+    up = [i]
+    while up[-1] != a:
+      up.append(self.parents[up[-1]])
+    down = [j]
+    while down[-1] != a:
+      down.append(self.parents[down[-1]])
+    return up + down[-2::-1]
+
+  def find(self, attrib, values):
+    """Get the nodes with attribute attrib equal to any of values, in document order"""
+    if attrib not in self._attrib_idx:
+      idx = {}
+      for i, v in enumerate(self.values(attrib)):
+        if v is not None:
+          idx.setdefault(v, []).append(i)
+      self._attrib_idx[attrib] = idx
+    idx = self._attrib_idx[attrib]
+    res = []
+    for v in values:
+      res.extend(idx.get(str(v), []))
+    return sorted(set(res))
+
+  def sequence(self, attrib='word_idx'):
+    """
+    Get the positional index of the nodes which have (int-valued) attribute attrib, as the list
+    of sorted values & the list of nodes in that (i.e. sentence) order; built once per tree
+    """
+    idx = self._seq_idx.get(attrib)
+    if idx is None:
+      vs = [(int(v), i) for i, v in enumerate(self.values(attrib)) if v is not None]
+      vs.sort()
+      idx = self._seq_idx[attrib] = ([v for v, _ in vs], [i for _, i in vs])
+    return idx
+
+  def seq_slice(self, attrib, lo, hi):
+    """Get the nodes with lo < attribute attrib < hi, in sentence order"""
+    values, nodes = self.sequence(attrib)
+    return nodes[bisect_right(values, lo):bisect_left(values, hi)]
+
+
+# Trees are typically queried by many templates & candidates in a row, e.g. one Compile.apply
+# call per candidate, so we keep the index for the last few documents seen around
+TREE_CACHE_SIZE = 16
+_tree_cache = OrderedDict()
+_tree_cache_lock = threading.Lock()
+
+def tree_paths(root, memo=None):
+  """
+  Get the TreePaths index of the tree that root belongs to
+  Indexes are cached per document, and reused only while the document is unchanged (see
+  TreePaths.is_current), as lxml trees may be edited in place between calls. A memo dict
+  skips this check for the templates & candidates applied to a tree in one go
+  """
+  if isinstance(root, TreePaths):
+    return root
+  doc_root = root.getroottree().getroot()
+  if memo is not None:
+    tp = memo.get('tree-paths')
+    if tp is not None and tp.root is doc_root:
+      return tp
+  if doc_root is None:
+    return TreePaths(root)
+  key = id(doc_root)
+  with _tree_cache_lock:
+    tp = _tree_cache.get(key)
+    if tp is not None and tp.root is doc_root:
+      _tree_cache.move_to_end(key)
+    else:
+      tp = None
+  if tp is None or not tp.is_current():
+    tp = TreePaths(doc_root)
+    with _tree_cache_lock:
+      _tree_cache[key] = tp
+      while len(_tree_cache) > TREE_CACHE_SIZE:
+        _tree_cache.popitem(last=False)
+  if memo is not None:
+    memo['tree-paths'] = tp
+  return tp
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+import json
+
+
+class OpProfile:
+  """
+  Profiling counters for a single operator of a Compile
+  Node set evaluation (xpath, or the native tree-path engine) is timed separately, so that
+  post_time is the time spent in python post-processing & feature generation
+  """
+  FIELDS = ['calls', 'features', 'wall', 'nodeset_time', 'nodeset_calls', 'nodeset_nodes', 'nodeset_max']
+
+  def __init__(self, op=''):
+    self.op = op
+    self.calls = 0
+    self.features = 0
+    self.wall = 0.0
+    self.nodeset_time = 0.0
+    self.nodeset_calls = 0
+    self.nodeset_nodes = 0
+    self.nodeset_max = 0
+
+  def nodeset(self, t, n):
+    """Record a node set evaluation taking t seconds and returning n nodes"""
+    self.nodeset_time += t
+    self.nodeset_calls += 1
+    self.nodeset_nodes += n
+    self.nodeset_max = max(self.nodeset_max, n)
+
+  @property
+  def post_time(self):
+    return self.wall - self.nodeset_time
+
+  @property
+  def nodeset_avg(self):
+    return self.nodeset_nodes / float(self.nodeset_calls) if self.nodeset_calls > 0 else 0.0
+
+  def merge(self, other):
+    for f in self.FIELDS:
+      if f == 'nodeset_max':
+        self.nodeset_max = max(self.nodeset_max, other.nodeset_max)
+      else:
+        setattr(self, f, getattr(self, f) + getattr(other, f))
+
+  def to_dict(self):
+    d = dict((f, getattr(self, f)) for f in self.FIELDS)
+    d['op'] = self.op
+    return d
+
+  @classmethod
+  def from_dict(cls, d):
+    p = cls(d['op'])
+    for f in cls.FIELDS:
+      setattr(p, f, d[f])
+    return p
+
+
+class Profiler:
+  """
+  Collects an OpProfile per operator of a Compile (see Compile(..., profile=True))
+  Operators are keyed by their position & repr, so that dumps from different workers running
+  the same templates can be merged
+  """
+  SORT_KEYS = ['wall', 'calls', 'features', 'nodeset_time', 'post_time', 'nodeset_avg', 'nodeset_max']
+
+  def __init__(self):
+    self.ops = OrderedDict()
+    self._keys = {}
+
+  def op(self, i, op):
+    """Get the OpProfile for the ith operator op"""
+    if (i, id(op)) not in self._keys:
+      self._keys[(i, id(op))] = (i, repr(op))
+    key = self._keys[(i, id(op))]
+    if key not in self.ops:
+      self.ops[key] = OpProfile(key[1])
+    return self.ops[key]
+
+  def reset(self):
+    self.ops = OrderedDict()
+
+  def to_dict(self):
+    """Machine-readable form, e.g. for aggregating across workers"""
+    return {'ops' : [dict(p.to_dict(), idx=i) for (i, _), p in self.ops.items()]}
+
+  def merge(self, d):
+    """Merge in another Profiler, or the to_dict() output of one"""
+    if isinstance(d, Profiler):
+      d = d.to_dict()
+    for pd in d['ops']:
+      key = (pd['idx'], pd['op'])
+      if key not in self.ops:
+        self.ops[key] = OpProfile(key[1])
+      self.ops[key].merge(OpProfile.from_dict(pd))
+
+  def dump(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_dict(), f, indent=2)
+
+  @classmethod
+  def load(cls, *paths):
+    """Load & merge one or more dumps"""
+    prof = cls()
+    for path in paths:
+      with open(path) as f:
+        prof.merge(json.load(f))
+    return prof
+
+  def report(self, sort_by='wall', top=None, width=80):
+    """Get a table of the operators sorted by sort_by (one of Profiler.SORT_KEYS), descending"""
+    if sort_by not in self.SORT_KEYS:
+      raise ValueError("sort_by must be one of %s" % self.SORT_KEYS)
+    ops = sorted(self.ops.items(), key=lambda x : getattr(x[1], sort_by), reverse=True)[:top]
+    total = sum(p.wall for p in self.ops.values())
+    lines = ['%4s %8s %9s %9s %6s %9s %9s %7s %6s  %s' % ('idx', 'calls', 'features', 'wall(s)', '%', 'nodes(s)', 'post(s)', 'avg|N|', 'max|N|', 'op')]
+    for (i, _), p in ops:
+      lines.append('%4d %8d %9d %9.3f %6.1f %9.3f %9.3f %7.1f %6d  %s' % (i, p.calls, p.features, p.wall,
+        100.0 * p.wall / total if total > 0 else 0.0, p.nodeset_time, p.post_time, p.nodeset_avg,
+        p.nodeset_max, p.op[:width]))
+    return '\n'.join(lines)
+
+  def __repr__(self):
+    return self.report()
@@ -1,17 +1,14 @@
+from array import array
 import json
 import os
 import re
 import lxml.etree as et
+import struct
 import sys
+from treedlib.paths import TreePaths
 
-# This should be set by the lib wrapper __init__.py file
-APP_HOME = os.environ["TREEDLIB_LIB"]
-
-# Load IPython display functionality libs if possible i.e. if in IPython
-try:
-  from IPython.core.display import display_html, HTML, display_javascript, Javascript
-except:
-  pass
+# The package directory, holding the vis/ html & js files
+APP_HOME = os.path.dirname(os.path.realpath(__file__))
 
 class XMLTree:
   """
@@ -45,7 +42,10 @@ class XMLTree:
     """
     Renders d3 visualization of the d3 tree, for IPython notebook display
     Depends on html/js files in vis/ directory, which is assumed to be in same dir...
+    Note: IPython is only imported here, rather than on import, as it is slow to load
     """
+    from IPython.core.display import display_html, HTML, display_javascript, Javascript
+
     # HTML
     WORD = '<span class="word-' + self.id + '-%s">%s</span>'
     words = ' '.join(WORD % (i,w) for i,w in enumerate(self.words)) if self.words else ''
@@ -58,16 +58,15 @@ class XMLTree:
     display_javascript(Javascript(data=js, lib=JS_LIBS))
 
 
-def corenlp_to_xmltree(s, prune_root=True):
-  """
-  Transforms an object with CoreNLP dep_path and dep_parent attributes into an XMLTree
-  Will include elements of any array having the same dimensiion as dep_* as node attributes
-  Also adds special word_idx attribute corresponding to original sequence order in sentence
-  """
+def _corenlp_input(s):
+  """Convert a CoreNLP input object to a dict, and get its (0-based root) dep_parents"""
   # Convert input object to dictionary
   if type(s) != dict:
     try:
-      s = s.__dict__ if hasattr(s, '__dict__') else dict(s)
+      if hasattr(s, '_asdict'):
+        s = s._asdict()
+      else:
+        s = s.__dict__ if hasattr(s, '__dict__') else dict(s)
     except:
       raise ValueError("Cannot convert input object to dict")
 
@@ -83,8 +82,21 @@ def corenlp_to_xmltree(s, prune_root=True):
   b = min(dep_parents)
   if b != 0:
     dep_parents = list(map(lambda j : j - b, dep_parents))
+  return s, dep_parents
+
+def _ascii(x):
+  """Strip any non-ascii characters from the string form of x"""
+  return str(x).encode('ascii', 'ignore').decode()
 
-  # Parse recursively
+def corenlp_to_xmltree(s, prune_root=True):
+  """
+  Transforms an object with CoreNLP dep_path and dep_parent attributes into an XMLTree
+  Will include elements of any array having the same dimensiion as dep_* as node attributes
+  Also adds special word_idx attribute corresponding to original sequence order in sentence
+  """
+  s, dep_parents = _corenlp_input(s)
+
+  # Build the tree
   root = corenlp_to_xmltree_sub(s, dep_parents, 0)
 
   # Often the return tree will have several roots, where one is the actual root
@@ -99,27 +111,217 @@ def corenlp_to_xmltree(s, prune_root=True):
   return XMLTree(root, words=s['words'])
 
 def corenlp_to_xmltree_sub(s, dep_parents, rid=0):
-  i = rid - 1
-  attrib = {}
+  """
+  Builds the tree rooted at rid in linear time: one pass to index the children of each node,
+  and one pass to collect the attribute columns (any list with the same dimension as
+  dep_parents), rather than rescanning both for every node
+  """
   N = len(dep_parents)
+  children = [[] for _ in range(N + 1)]
+  for i,d in enumerate(dep_parents):
+    if 0 <= d <= N:
+      children[d].append(i + 1)
 
   # Add all attributes that have the same shape as dep_parents
-  if i >= 0:
-    for k,v in filter(lambda t : type(t[1]) == list and len(t[1]) == N, s.items()):
-      if v[i] is not None:
-        attrib[singular(k)] = ''.join(c for c in str(v[i]) if ord(c) < 128)
+  cols = []
+  for k,v in s.items():
+    if type(v) == list and len(v) == N:
+      cols.append((singular(k), [None if x is None else _ascii(x) for x in v]))
 
-    # Add word_idx if not present
-    if 'word_idx' not in attrib:
-      attrib['word_idx'] = str(i)
+  def node_attrib(j):
+    i = j - 1
+    attrib = {}
+    if i >= 0:
+      for a, col in cols:
+        if col[i] is not None:
+          attrib[a] = col[i]
 
-  # Build tree recursively
-  root = et.Element('node', attrib=attrib)
-  for i,d in enumerate(dep_parents):
-    if d == rid:
-      root.append(corenlp_to_xmltree_sub(s, dep_parents, i+1))
+      # Add word_idx if not present
+      if 'word_idx' not in attrib:
+        attrib['word_idx'] = str(i)
+    return attrib
+
+  # Build tree iteratively
+  root = et.Element('node', attrib=node_attrib(rid))
+  stack = [(root, rid)]
+  while len(stack) > 0:
+    node, j = stack.pop()
+    for c in children[j]:
+      stack.append((et.SubElement(node, 'node', attrib=node_attrib(c)), c))
   return root
 
+
+class ArrayTree(TreePaths):
+  """
+  A compact, array-backed alternative to the lxml tree of an XMLTree
+  ---------------
+  Nodes are integer indexes in document (preorder) order, with node 0 being the attribute-less
+  root, exactly mirroring the xml document built by corenlp_to_xmltree- so NodeSet operators
+  evaluate directly (and identically) against it; those without a native evaluation (e.g.
+  Between of non-mention node sets) fall back to xpath over the mirroring xml document.
+  Node attributes are stored as columns of ids into the tree's own string table (-1 for
+  missing), which is freed along with the tree
+  """
+  # Binary format header: magic, version, prune_root, # nodes, # columns, # words (-1 if None),
+  # column names blob length, strings blob length
+  HEADER = struct.Struct('<4sHHiiiii')
+  MAGIC = b'TDAT'
+  VERSION = 1
+
+  def __init__(self, parents, columns, word_ids=None, prune_root=True, strings=None):
+    self._index(parents)
+    self.columns = columns
+    self.word_ids = word_ids
+    self.prune_root = prune_root
+    self.strings = [] if strings is None else strings
+
+  def get(self, i, attrib):
+    col = self.columns.get(attrib)
+    if col is None or col[i] < 0:
+      return None
+    return self.strings[col[i]]
+
+  @property
+  def words(self):
+    return None if self.word_ids is None else [self.strings[i] for i in self.word_ids]
+
+  def to_bytes(self):
+    """
+    Serialize to a compact binary form: the header, then the int32 index arrays, attribute
+    columns & word ids, then the column names and (per-tree) string table, NUL-separated
+    """
+    # Remap the string ids to a per-tree string table
+    local = {}
+    strings = []
+    def remap(ids):
+      out = array('i', [-1]) * len(ids)
+      for k,i in enumerate(ids):
+        if i >= 0:
+          if i not in local:
+            local[i] = len(strings)
+            strings.append(self.strings[i])
+          out[k] = local[i]
+      return out
+    names = list(self.columns.keys())
+    columns = [remap(self.columns[a]) for a in names]
+    word_ids = remap(self.word_ids) if self.word_ids is not None else array('i')
+    names_blob = '\0'.join(names).encode('utf-8')
+    strings_blob = '\0'.join(strings).encode('utf-8')
+    if strings_blob.count(b'\0') != max(0, len(strings) - 1):
+      raise ValueError("Cannot serialize attribute values containing NUL characters")
+    header = self.HEADER.pack(self.MAGIC, self.VERSION, int(self.prune_root), len(self), len(names),
+                              len(self.word_ids) if self.word_ids is not None else -1, len(names_blob), len(strings_blob))
+    arrays = [self.parents, self.depths, self.sib_idx, self.child_offsets, self.child_idx, self.ends] + columns + [word_ids]
+    return b''.join([header] + [a.tobytes() for a in arrays] + [names_blob, strings_blob])
+
+  @classmethod
+  def from_bytes(cls, buf):
+    """Load a tree serialized by to_bytes from a buffer (e.g. a slice of an mmap), without re-indexing"""
+    buf = memoryview(buf)
+    magic, version, prune_root, n, n_cols, n_words, names_len, strings_len = cls.HEADER.unpack_from(buf)
+    if magic != cls.MAGIC or version != cls.VERSION:
+      raise ValueError("Not a serialized ArrayTree (version %s)" % cls.VERSION)
+    o = cls.HEADER.size
+    def read(k):
+      nonlocal o
+      a = array('i')
+      a.frombytes(buf[o:o + 4*k])
+      o += 4*k
+      return a
+    t = cls.__new__(cls)
+    t.parents = read(n)
+    t.depths = read(n)
+    t.sib_idx = read(n)
+    t.child_offsets = read(n + 1)
+    t.child_idx = read(max(0, n - 1))
+    t.ends = read(n)
+    columns = [read(n) for _ in range(n_cols)]
+    t.word_ids = read(n_words) if n_words >= 0 else None
+    names = bytes(buf[o:o + names_len]).decode('utf-8').split('\0') if n_cols > 0 else []
+    o += names_len
+    t.strings = bytes(buf[o:o + strings_len]).decode('utf-8').split('\0')
+    t.columns = dict(zip(names, columns))
+    t.prune_root = bool(prune_root)
+    t._attrib_idx = {}
+    t._seq_idx = {}
+    t._values = {}
+    return t
+
+  def xml_elements(self):
+    """Build the mirroring lxml document, getting its elements in node order"""
+    elems = []
+    for i,p in enumerate(self.parents):
+      attrib = {}
+      for a,col in self.columns.items():
+        if col[i] >= 0:
+          attrib[a] = self.strings[col[i]]
+      elems.append(et.Element('node', attrib=attrib) if p < 0 else et.SubElement(elems[p], 'node', attrib=attrib))
+    return elems
+
+  def to_xmltree(self):
+    """Convert to an XMLTree, e.g. for visualization"""
+    root = self.xml_elements()[0]
+    if self.prune_root and len(root) == 1:
+      root = root[0]
+    return XMLTree(root, words=self.words)
+
+
+def corenlp_to_arraytree(s, prune_root=True):
+  """
+  Transforms an object with CoreNLP dep_path and dep_parent attributes into an ArrayTree
+  Takes the same input, and represents the same tree, as corenlp_to_xmltree
+  """
+  s, dep_parents = _corenlp_input(s)
+  N = len(dep_parents)
+  children = [[] for _ in range(N + 1)]
+  for i,d in enumerate(dep_parents):
+    if 0 <= d <= N:
+      children[d].append(i + 1)
+
+  # Optionally remove the singletons not included in the dep tree parse (see corenlp_to_xmltree)
+  if prune_root:
+    children[0] = [c for c in children[0] if len(children[c]) > 0]
+
+  # Get the preorder ordering & parent array
+  order = []
+  parents = []
+  stack = [(0, -1)]
+  while len(stack) > 0:
+    j, p = stack.pop()
+    parents.append(p)
+    stack.extend((c, len(order)) for c in reversed(children[j]))
+    order.append(j)
+
+  # Attribute values are interned into a string table of the tree's own
+  strings = []
+  string_ids = {}
+  def intern_string(v):
+    i = string_ids.get(v)
+    if i is None:
+      i = string_ids[v] = len(strings)
+      strings.append(v)
+    return i
+
+  # Add all attributes that have the same shape as dep_parents as columns
+  columns = {}
+  for k,v in s.items():
+    if type(v) == list and len(v) == N:
+      a = singular(k)
+      col = columns.setdefault(a, array('i', [-1]) * len(order))
+      for i in range(1, len(order)):
+        x = v[order[i] - 1]
+        if x is not None:
+          col[i] = intern_string(_ascii(x))
+
+  # Add word_idx if not present
+  col = columns.setdefault('word_idx', array('i', [-1]) * len(order))
+  for i in range(1, len(order)):
+    if col[i] < 0:
+      col[i] = intern_string(str(order[i] - 1))
+  words = s.get('words')
+  word_ids = array('i', (intern_string(str(w)) for w in words)) if type(words) == list else None
+  return ArrayTree(parents, columns, word_ids=word_ids, prune_root=prune_root, strings=strings)
+
 def singular(s):
   """Get singular form of word s (crudely)"""
   return re.sub(r'e?s$', '', s, flags=re.I)
@@ -1,7 +1,47 @@
-from itertools import chain
+from itertools import chain, islice, product
 import re
 import lxml.etree as et
-from collections import defaultdict
+from collections import deque, OrderedDict
+from functools import lru_cache, reduce
+from hashlib import blake2b
+from time import perf_counter
+from treedlib.paths import TreePaths, tree_paths
+from treedlib.profiling import Profiler
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  import sre_parse
+
+
+# XPATH COMPILATION:
+# ===========
+
+# Max number of compiled xpath expressions kept around; NodeSet templates are compiled
+# once each, so this mainly bounds any expressions built on the fly
+XPATH_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=XPATH_CACHE_SIZE)
+def compile_xpath(xpath):
+  """Get a compiled lxml XPath object for an xpath string (LRU-cached)"""
+  return et.XPath(xpath)
+
+@lru_cache(maxsize=XPATH_CACHE_SIZE)
+def compile_nodeset_xpath(xpath, cid_attrib, shape):
+  """
+  Compile a NodeSet xpath template once per candidate shape (i.e. the number of ids in
+  each mention), with the candidate mention ids bound to XPath variables $m0_0, $m0_1, ...
+  rather than string-substituted in
+  """
+  m = [" or ".join("@%s=$m%s_%s" % (cid_attrib, i, j) for j in range(k)) for i,k in enumerate(shape)]
+  return compile_xpath(xpath.format(*m))
+
+def xpath_nodes(root, xpath, cids, cid_attrib='word_idx'):
+  """Execute a NodeSet xpath template against root, for the candidate mention ids provided"""
+  mvars = {}
+  for i,cid in enumerate(cids):
+    for j,c in enumerate(cid):
+      mvars['m%s_%s' % (i,j)] = str(c)
+  return compile_nodeset_xpath(xpath, cid_attrib, tuple(len(cid) for cid in cids))(root, **mvars)
 
 
 # NODESET:
@@ -14,22 +54,114 @@ class NodeSet:
   They are applied compositionally and lazily, by constructing an xpath query
   We use these to get the *subtree* or set of nodes that our indicicator features will
   operate over
+  ---------------
+  NodeSets flagged as native are instead evaluated in python over a TreePaths index, via
+  _native_groups: this returns the result of the *last xpath step* grouped by context node,
+  each group in axis (proximity) order, so that a subsequent [1] selects g[0] of each group
   """
+  native = False  # Whether to use the native tree-path engine rather than xpath
+
   def __init__(self, label='NODESET', xpath='//*', psort=None):
     self.label = label
     self.xpath = xpath
     self.psort = psort  # Attribute to sort on post-xpath execution
 
+  def get_nodes(self, root, cids, cid_attrib='word_idx', memo=None):
+    """
+    Get the nodes of the tree root belongs to in this set, in document order
+    For an lxml root these are elements; for an ArrayTree (or other TreePaths) root these
+    are integer node indexes- see node_getter. The tree's index is cached per document (see tree_paths)
+    """
+    if isinstance(root, TreePaths):
+      if not self._native_ok():
+        return _mirror_xpath_nodes(root, self.xpath, cids, cid_attrib, memo)
+      return sorted(set(chain.from_iterable(self._native_groups(root, cids, cid_attrib))))
+    if self.native and self._native_ok():
+      tp = tree_paths(root, memo)
+      return [tp.nodes[i] for i in sorted(set(chain.from_iterable(self._native_groups(tp, cids, cid_attrib))))]
+    return xpath_nodes(root, self.xpath, cids, cid_attrib)
+
+  def _native_ok(self):
+    """Whether this NodeSet can be evaluated by _native_groups"""
+    return False
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    raise NotImplementedError()
+
+  def uses_cids(self):
+    """Whether the node set depends on the candidate mention ids, i.e. has {i} placeholders"""
+    return re.search(r'\{\d+\}', self.xpath) is not None
+
   def __repr__(self):
     return '<%s, xpath="%s">' % (self.label, self.xpath)
 
 
+def _mirror_xpath_nodes(tp, xpath, cids, cid_attrib='word_idx', memo=None):
+  """
+  Evaluate xpath over the xml document mirroring a TreePaths tree (e.g. an ArrayTree), built once
+  per memo dict, mapping the resulting elements back to node indexes
+  """
+  mirror = memo.get('xml-mirror') if memo is not None else None
+  if mirror is None or mirror[0] is not tp:
+    elems = tp.xml_elements()
+    mirror = (tp, elems, dict((e, i) for i, e in enumerate(elems)))
+    if memo is not None:
+      memo['xml-mirror'] = mirror
+  idx = mirror[2]
+  return [idx[e] for e in xpath_nodes(mirror[1][0], xpath, cids, cid_attrib)]
+
+def _xml_get(node, attrib):
+  return node.get(attrib)
+
+def node_getter(root):
+  """Get a function get(node, attrib) for the nodes returned by NodeSet.get_nodes on root"""
+  return root.get if isinstance(root, TreePaths) else _xml_get
+
+
+def sentence_nodes(root, seq_attrib='word_idx', memo=None):
+  """Get the nodes of the tree which have seq_attrib, sorted by it (i.e. in sentence order)"""
+  tp = tree_paths(root, memo)
+  nodes = tp.sequence(seq_attrib)[1]
+  return list(nodes) if tp is root else [tp.nodes[i] for i in nodes]
+
+def seq_nodes(root, seq_attrib, lo, hi, memo=None):
+  """
+  Get the nodes of the tree with lo < seq_attrib < hi, in sentence order, as a direct slice of
+  the positional index of the tree (see TreePaths.sequence), which is shared by all templates
+  & candidates over the same tree via the memo dict
+  """
+  tp = tree_paths(root, memo)
+  nodes = tp.seq_slice(seq_attrib, lo, hi)
+  return nodes if tp is root else [tp.nodes[i] for i in nodes]
+
+
+def _first_of_groups(groups):
+  """The context nodes of the next xpath step, i.e. the result of appending [1]"""
+  return sorted(set(g[0] for g in groups))
+
+
 class Mention(NodeSet):
-  """Gets candidate mention nodes"""
+  """
+  Gets candidate mention nodes
+  These are looked up in the (cached) attribute index of the tree, rather than by a scan of the
+  whole tree via xpath
+  """
+  native = True
+
   def __init__(self, cid=0):
     self.label = 'MENTION'
+    self.cid = cid
     self.xpath = "//*[{%s}]" % str(cid)
 
+  def _native_ok(self):
+    return True
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = OrderedDict()
+    for i in tp.find(cid_attrib, cids[self.cid]):
+      groups.setdefault(tp.parents[i], []).append(i)
+    return list(groups.values())
+
 
 class LeftSiblings(NodeSet):
   """Gets preceding siblings"""
@@ -37,6 +169,18 @@ class LeftSiblings(NodeSet):
     self.__dict__.update(ns.__dict__) # inherit child object's attributes
     self.label = 'LEFT-OF-%s' % ns.label
     self.xpath = '%s[1]/preceding-sibling::*[position() <= %s]' % (ns.xpath, w)
+    self.ns = ns
+    self.w = w
+
+  def _native_ok(self):
+    return self.ns._native_ok()
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = []
+    for i in _first_of_groups(self.ns._native_groups(tp, cids, cid_attrib)):
+      s = tp.sib_idx[i]
+      groups.append(tp.siblings(i)[max(0, s - self.w):s][::-1])
+    return [g for g in groups if len(g) > 0]
 
 
 class RightSiblings(NodeSet):
@@ -45,6 +189,18 @@ class RightSiblings(NodeSet):
     self.__dict__.update(ns.__dict__) # inherit child object's attributes
     self.label = 'RIGHT-OF-%s' % ns.label
     self.xpath = '%s[1]/following-sibling::*[position() <= %s]' % (ns.xpath, w)
+    self.ns = ns
+    self.w = w
+
+  def _native_ok(self):
+    return self.ns._native_ok()
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = []
+    for i in _first_of_groups(self.ns._native_groups(tp, cids, cid_attrib)):
+      s = tp.sib_idx[i]
+      groups.append(tp.siblings(i)[s+1:s+1+max(0, self.w)])
+    return [g for g in groups if len(g) > 0]
 
 
 # TODO: These should be "Descendants" / "Ancestors"...
@@ -54,6 +210,14 @@ class Children(NodeSet):
     self.__dict__.update(ns.__dict__) # inherit child object's attributes
     self.label = 'CHILDREN-OF-%s' % ns.label
     self.xpath = ns.xpath + '[1]/*'
+    self.ns = ns
+
+  def _native_ok(self):
+    return self.ns._native_ok()
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = [tp.children(i) for i in _first_of_groups(self.ns._native_groups(tp, cids, cid_attrib))]
+    return [g for g in groups if len(g) > 0]
 
 
 class Parents(NodeSet):
@@ -62,17 +226,88 @@ class Parents(NodeSet):
     self.__dict__.update(ns.__dict__) # inherit child object's attributes
     self.label = 'PARENTS-OF-%s' % ns.label
     self.xpath = ns.xpath + '[1]/ancestor::*[position()<%s]' % (num_parents + 1)
+    self.ns = ns
+    self.num_parents = num_parents
+
+  def _native_ok(self):
+    return self.ns._native_ok()
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = [list(islice(tp.ancestors(i), max(0, self.num_parents))) for i in _first_of_groups(self.ns._native_groups(tp, cids, cid_attrib))]
+    return [g for g in groups if len(g) > 0]
 
 
 class Between(NodeSet):
   """
   Gets the nodes between two node sets
-  Note: this requires some ugly xpath... could change this to non-xpath method
+  Note: the xpath here is pretty ugly (and slow on deep trees), so when both node sets are
+  simple mentions we default to evaluating via lowest common ancestors over TreePaths
   """
   def __init__(self, ns1, ns2):
     self.__dict__.update(ns1.__dict__) # inherit *FIRST* child object's attributes
     self.label = 'BETWEEN-%s-and-%s' % (ns1.label, ns2.label)
     self.xpath = "{0}[1]/ancestor-or-self::*[count(. | {1}[1]/ancestor-or-self::*) = count({1}[1]/ancestor-or-self::*)][1]/descendant-or-self::*[((count(.{0}) = count({0})) or (count(.{1}) = count({1})))]".format(ns1.xpath, ns2.xpath)
+    self.ns1 = ns1
+    self.ns2 = ns2
+    self.native = self._native_ok()
+
+  def _native_ok(self):
+    # Note: the count(.{0}) trick only means "descendants of . in {0}" for //*[...] paths
+    return _is_mention(self.ns1) and _is_mention(self.ns2)
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    g1 = self.ns1._native_groups(tp, cids, cid_attrib)
+    g2 = self.ns2._native_groups(tp, cids, cid_attrib)
+    if len(g1) == 0 or len(g2) == 0:
+      return []
+
+    # Single node sets (e.g. one-word mentions): the dependency path between the two nodes,
+    # less its ends- but for the lca, if it is one of them
+    if len(g1) == 1 and len(g2) == 1 and len(g1[0]) == 1 and len(g2[0]) == 1:
+      i, j = g1[0][0], g2[0][0]
+      if i == j:
+        return []
+      path = tp.path(i, j)
+      a = min(path, key=tp.depths.__getitem__)
+      return [sorted(set(path[1:-1]).union([a]))]
+
+    # Get the lowest ancestor-or-self of each first node of ns1 which is an
+    # ancestor-or-self of some first node of ns2
+    anc2 = set()
+    for j in _first_of_groups(g2):
+      anc2.add(j)
+      anc2.update(tp.ancestors(j))
+    lcas = set()
+    for i in _first_of_groups(g1):
+      while i not in anc2:
+        i = tp.parents[i]
+      lcas.add(i)
+
+    # Nodes which are strict ancestors of *all* nodes of either set
+    path = set()
+    for g in (g1, g2):
+      ns = set(chain.from_iterable(g))
+      a = reduce(tp.lca, ns)
+      if a not in ns:
+        path.add(a)
+      path.update(tp.ancestors(a))
+
+    # Restrict to the subtree under each lca
+    groups = [sorted(i for i in path if tp.is_ancestor_or_self(a, i)) for a in sorted(lcas)]
+    return [g for g in groups if len(g) > 0]
+
+
+def _is_mention(ns):
+  """Whether ns selects //*[...] from the whole tree, i.e. is a (filtered) Mention"""
+  return isinstance(ns, Mention) or (isinstance(ns, Filter) and _is_mention(ns.ns))
+
+def _seq_filters(ns):
+  """If ns is a (filtered) SeqBetween, get its Filters, innermost first; else None"""
+  filters = []
+  while isinstance(ns, Filter):
+    filters.append(ns)
+    ns = ns.ns
+  return filters[::-1] if isinstance(ns, SeqBetween) else None
 
 
 class SeqBetween(NodeSet):
@@ -86,6 +321,13 @@ class SeqBetween(NodeSet):
     self.seq_attrib = seq_attrib # Logic gets pushed to Indicator...
     self.psort = seq_attrib # Specify that post-xpath sorting needs to be done
 
+  def _native_ok(self):
+    return True
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    groups = [[0]] + [tp.children(i) for i in range(len(tp))]
+    return [g for g in groups if len(g) > 0]
+
 
 class Filter(NodeSet):
   """
@@ -97,6 +339,43 @@ class Filter(NodeSet):
     self.label = 'FILTER-BY(%s=%s):%s' % (filter_attr, filter_by, ns.label)
     temp = "[starts-with(@%s, '%s')]" if starts_with else "[@%s='%s']"
     self.xpath = ns.xpath + temp % (filter_attr, filter_by)
+    self.ns = ns
+    self.filter_attr = filter_attr
+    self.filter_by = filter_by
+    self.starts_with = starts_with
+
+  def accepts(self, v):
+    """Whether a node with filter_attr value v (None if not present) is in the filtered set"""
+    return (v or '').startswith(self.filter_by) if self.starts_with else v == self.filter_by
+
+  def _native_ok(self):
+    return self.ns._native_ok()
+
+  def _native_groups(self, tp, cids, cid_attrib):
+    f = lambda i : self.accepts(tp.get(i, self.filter_attr))
+    groups = [list(filter(f, g)) for g in self.ns._native_groups(tp, cids, cid_attrib)]
+    return [g for g in groups if len(g) > 0]
+
+
+def shared_nodes(ns, root, cids, cid_attrib='word_idx', memo=None):
+  """
+  Get ns.get_nodes(root, cids, cid_attrib), evaluating structurally identical NodeSets (i.e. with
+  the same xpath) just once per tree & candidate via the memo dict
+  Filters are applied in python over the shared node set they filter, so that e.g. Between and
+  the Filters of it share one evaluation. Note: the lists returned must not be modified
+  """
+  if memo is None:
+    return ns.get_nodes(root, cids, cid_attrib)
+  key = ('nodes', ns.xpath, cid_attrib, tuple(map(tuple, cids)) if ns.uses_cids() else None)
+  nodes = memo.get(key)
+  if nodes is None:
+    if isinstance(ns, Filter):
+      get = node_getter(root)
+      nodes = [n for n in shared_nodes(ns.ns, root, cids, cid_attrib, memo) if ns.accepts(get(n, ns.filter_attr))]
+    else:
+      nodes = ns.get_nodes(root, cids, cid_attrib, memo)
+    memo[key] = nodes
+  return nodes
 
 
 # INDICATOR:
@@ -108,6 +387,7 @@ def compile_dict_sub(brown_clusters_path=None, user_dicts=[]):
   AND/OR a file path to a tsv file list of (word, brown cluster id) lines
   And returns a single dictionary mapping from word -> DICT_LABEL, based on priority ordering
   Assume user dicts take priority over brown clusters...
+  For large cluster files, see treedlib.dictsub for a memory-mapped index of this mapping
   """
   dict_sub = {}
 
@@ -119,10 +399,14 @@ def compile_dict_sub(brown_clusters_path=None, user_dicts=[]):
 
   # Brown clusters
   if brown_clusters_path is not None:
-    with open(brown_clusters_path, 'rb') as f:
+    user_words = set(dict_sub)
+    with open(brown_clusters_path, encoding='utf-8') as f:
       for line in f:
-        word, cluster_id = line.rstrip().split('\t')
-        dict_sub[word] = 'BC-%s' % cluster_id
+        if len(line.strip()) == 0:
+          continue
+        word, cluster_id = line.rstrip('\r\n').split('\t')
+        if word not in user_words:
+          dict_sub[word] = 'BC-%s' % cluster_id
   return dict_sub
 
 
@@ -137,43 +421,40 @@ class Indicator:
     self.ns = ns
     self.attribs = attribs
 
-  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, inv_tag=True, stopwords=None, dict_sub={}):
+  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, inv_tag=True, stopwords=None, dict_sub={}, memo=None, prof=None):
     """
     Apply the feature template to the xml tree provided
     A list of lists of candidate mention ids are passed in, as well as a cid_attrib
     These identify the candidate mentions refered to by index in Mention
     For example, cids=[[1,2]], cid_attrib='word_idx' will have mention 0 as the set of nodes
     that have word index 1 and 2
+    Optionally a memo dict can be passed in, to share sentence-level (i.e. candidate-independent)
+    work across calls for different candidates in the *same* tree- see Compile.apply_batch
+    If an OpProfile prof is passed in, node set evaluation is recorded to it
     """
-    # Sub in the candidate mention identifiers provided
-    m = [" or ".join("@%s='%s'" % (cid_attrib, c) for c in cid) for cid in cids] 
-    xpath = self.ns.xpath.format(*m)
-
     # INV tag if binary relation
     inv = 'INV_' if inv_tag and len(cids) == 2 and cids[0][0] > cids[1][0] else ''
+    res, label = self._result(root, cids, cid_attrib, inv, stopwords, dict_sub, memo, prof)
 
-    # Get nodes
-    nodes = root.xpath(xpath)
-
-    # Filter stopwords
-    if stopwords is not None and len(stopwords) > 0:
-      nodes = list(filter(lambda n : n.get('word') not in stopwords and n.get('lemma') not in stopwords, nodes))
-
-    # Perform seq filter here
-    if hasattr(self.ns, 'seq_attrib') and self.ns.seq_attrib is not None:
-      seqa = self.ns.seq_attrib
-      b = (cids[0][-1], cids[-1][0]) if cids[0][-1] < cids[-1][0] else (cids[-1][-1], cids[0][0])
-      nodes = list(filter(lambda n : n.get(seqa) is not None and int(n.get(seqa)) > b[0] and int(n.get(seqa)) < b[1], nodes))
+    # Only yield if non-zero result set; process through _get_features fn
+    if len(res) > 0:
+      for feat in self._label_features(res, label, feat_label):
+        yield feat
 
-    # If sort specified, perform here
-    if hasattr(self.ns, 'psort') and self.ns.psort is not None:
-      nodes.sort(key=lambda n : int(n.get(self.ns.psort)))
+  def _result(self, root, cids, cid_attrib='word_idx', inv='', stopwords=None, dict_sub={}, memo=None, prof=None):
+    """Get the result set of attribute values (or nodes, if no attribs) & the feature label"""
+    # Get nodes, substituting in the candidate mention identifiers provided
+    nodes = self._get_nodes(root, cids, cid_attrib, stopwords=stopwords, memo=memo, prof=prof)
+    get = node_getter(root)
 
     # Specifically handle single attrib or multiple attribs per node here
     try:
-      attribs = re.split(r'\s*,\s*', self.attribs)
-      res = ['|'.join(str(node.get(a)) for a in attribs) for node in nodes]
-      label = '%s%s:%s' % (inv, '|'.join(attribs).upper(), self.ns.label)
+      attribs, label = self._label(inv)
+      if len(attribs) == 1:
+        a = attribs[0]
+        res = [str(get(node, a)) for node in nodes]
+      else:
+        res = ['|'.join(str(get(node, a)) for a in attribs) for node in nodes]
 
       # Check each result value against a dictionary which maps string -> DICT_NAME,
       # and replace with the value "DICT_NAME"
@@ -184,14 +465,66 @@ class Indicator:
     except AttributeError:
       res = nodes
       label = '%s%s' % (inv, self.ns.label)
-    
-    # Only yield if non-zero result set; process through _get_features fn
-    if len(res) > 0:
-      for feat in self._get_features(res):
-        if feat_label:
-          yield '%s[%s]' % (label, feat)
-        else:
-          yield feat
+    return res, label
+
+  def _label(self, inv=''):
+    """Get the list of attributes & the feature label- these are computed just once per template"""
+    key = (inv, self.attribs, self.ns.label)
+    cache = self.__dict__.setdefault('_label_cache', {})
+    if key not in cache:
+      attribs = re.split(r'\s*,\s*', self.attribs)
+      cache[key] = (attribs, '%s%s:%s' % (inv, '|'.join(attribs).upper(), self.ns.label))
+    return cache[key]
+
+  def _label_features(self, res, label, feat_label=True):
+    """Get the features of the result set, optionally labeled"""
+    if feat_label:
+      return ('%s[%s]' % (label, feat) for feat in self._get_features(res))
+    return self._get_features(res)
+
+  def _eval_nodeset(self, root, cids, cid_attrib='word_idx', memo=None, prof=None):
+    """Evaluate the NodeSet (shared via memo), timing it if an OpProfile prof is passed in"""
+    if prof is None:
+      return shared_nodes(self.ns, root, cids, cid_attrib, memo)
+    t = perf_counter()
+    nodes = shared_nodes(self.ns, root, cids, cid_attrib, memo)
+    prof.nodeset(perf_counter() - t, len(nodes))
+    return nodes
+
+  def _get_nodes(self, root, cids, cid_attrib='word_idx', stopwords=None, memo=None, prof=None):
+    """Get the nodes of the NodeSet, after stopword & seq filtering and post-xpath sorting"""
+    get = node_getter(root)
+    seqa = getattr(self.ns, 'seq_attrib', None)
+    psort = getattr(self.ns, 'psort', None)
+    if seqa is not None:
+      b = (cids[0][-1], cids[-1][0]) if cids[0][-1] < cids[-1][0] else (cids[-1][-1], cids[0][0])
+
+    # A (filtered) SeqBetween is just a slice of the positional index of the tree
+    filters = _seq_filters(self.ns) if seqa is not None and psort == seqa else None
+    if filters is not None:
+      t = perf_counter() if prof is not None else None
+      nodes = seq_nodes(root, seqa, b[0], b[1], memo)
+      for f in filters:
+        nodes = [n for n in nodes if f.accepts(get(n, f.filter_attr))]
+      if prof is not None:
+        prof.nodeset(perf_counter() - t, len(nodes))
+      if stopwords is not None and len(stopwords) > 0:
+        nodes = list(filter(lambda n : get(n, 'word') not in stopwords and get(n, 'lemma') not in stopwords, nodes))
+      return nodes
+    nodes = self._eval_nodeset(root, cids, cid_attrib, memo, prof)
+
+    # Filter stopwords
+    if stopwords is not None and len(stopwords) > 0:
+      nodes = list(filter(lambda n : get(n, 'word') not in stopwords and get(n, 'lemma') not in stopwords, nodes))
+
+    # Perform seq filter here
+    if seqa is not None:
+      nodes = list(filter(lambda n : get(n, seqa) is not None and int(get(n, seqa)) > b[0] and int(get(n, seqa)) < b[1], nodes))
+
+    # If sort specified, perform here (not in place, as the node set may be shared)
+    if psort is not None:
+      nodes = sorted(nodes, key=lambda n : int(get(n, psort)))
+    return nodes
 
   def _get_features(self, res):
     """
@@ -204,55 +537,306 @@ class Indicator:
     for feat in self.apply(root, cids, cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords):
       print(feat)
 
-  def result_set(self, root, cids, cid_attrib='word_idx', feat_label=False, dict_sub={}, stopwords=None):
+  def result_set(self, root, cids, cid_attrib='word_idx', feat_label=False, dict_sub={}, stopwords=None, memo=None):
     """Get results as a set- mostly for use in DSR applications"""
-    res = set()
-    for feat in self.apply(root, cids, cid_attrib=cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords):
-      res.add(feat)
-    return res
+    return set(self.apply(root, cids, cid_attrib=cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords, memo=memo))
   
   def __repr__(self):
     return '<%s:%s:%s, xpath="%s">' % (self.__class__.__name__, self.attribs, self.ns.label, self.ns.xpath)
 
 
-class Ngrams(Indicator):
+# Ngram templates can output features as strings (default), as (label, ngram tuple) pairs, or
+# as 63-bit hashes of these (i.e. fitting a signed bigint), computed without building any strings
+NGRAM_OUTPUTS = ('str', 'tuple', 'hash')
+MASK64 = (1 << 64) - 1
+MASK63 = (1 << 63) - 1
+NGRAM_HASH_MULT = 0x100000001b3
+
+@lru_cache(maxsize=2**16)
+def _token_hash(token, seed=0):
+  """Stable (i.e. not python's hash) 64-bit hash of a string"""
+  return int.from_bytes(blake2b(token.encode('utf-8'), digest_size=8, key=seed.to_bytes(8, 'little')).digest(), 'little')
+
+def _mix64(h):
+  """splitmix64 finalizer"""
+  h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+  h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & MASK64
+  return h ^ (h >> 31)
+
+def ngram_hashes(res, spans, label=None, seed=0):
+  """
+  Get the 63-bit hashes of the ngrams res[s:e] for each span (s, e), optionally with the label
+  A polynomial rolling hash over the prefixes of res is computed once, so each hash is O(1)
+  """
+  ph = [0]
+  for t in res:
+    ph.append((ph[-1] * NGRAM_HASH_MULT + _token_hash(t, seed)) & MASK64)
+  pw = [1]
+  for _ in res:
+    pw.append((pw[-1] * NGRAM_HASH_MULT) & MASK64)
+  lh = _token_hash(label, seed) if label is not None else 0
+  return [_mix64((lh + (ph[e] - ph[s] * pw[e-s]) * NGRAM_HASH_MULT + e - s) & MASK64) & MASK63 for s, e in spans]
+
+
+class _NgramIndicator(Indicator):
+  """Base class for the ngram templates, handling the output modes"""
+  def __init__(self, ns, attribs, output='str', seed=0):
+    self.ns = ns
+    self.attribs = attribs
+    self._set_output(output, seed)
+
+  def _set_output(self, output, seed):
+    if output not in NGRAM_OUTPUTS:
+      raise ValueError("output must be one of %s" % (NGRAM_OUTPUTS,))
+    self.output = output
+    self.seed = seed
+
+  def _spans(self, n):
+    """Get the (start, end) spans of the ngrams of a result set of length n, in output order"""
+    raise NotImplementedError()
+
+  def _label_features(self, res, label, feat_label=True):
+    output = getattr(self, 'output', 'str')
+    if output == 'str':
+      return self._ngram_strings(res, '%s[' % label if feat_label else '', ']' if feat_label else '')
+    spans = self._spans(len(res))
+    if output == 'hash':
+      return ngram_hashes(res, spans, label if feat_label else None, seed=self.seed)
+    t = tuple(res)
+    return [(label, t[s:e]) for s, e in spans] if feat_label else [t[s:e] for s, e in spans]
+
+  def _get_features(self, res):
+    return self._ngram_strings(res, '', '')
+
+
+class Ngrams(_NgramIndicator):
   """
   Return indicator features over the ngrams of a result set
   If ng arg is an int, will get ngrams of *exactly* this length
   If ng arg is a list/tuple, will get all ngrams of this range, *inclusive*
   """
-  def __init__(self, ns, attribs, ng):
+  def __init__(self, ns, attribs, ng, output='str', seed=0):
     self.ns = ns
     self.attribs = attribs
     if (type(ng) == int and ng > 0) or (type(ng) in [list, tuple] and ng[0] > 0):
       self.ng = ng
     else:
       raise ValueError("Improper ngram range: %s" % ng)
-
-  def _get_features(self, res):
-    if type(self.ng) == int:
-      r = [self.ng - 1]
-    else:
-      r = range(self.ng[0] - 1, min(len(res), self.ng[1]))
-    return chain.from_iterable([' '.join(res[s:s+l+1]) for s in range(len(res)-l)] for l in r)
-
-
-class RightNgrams(Indicator):
+    self._set_output(output, seed)
+
+  def _lengths(self, n):
+    lo, hi = (self.ng, self.ng) if type(self.ng) == int else self.ng[:2]
+    return lo, min(n, hi)
+
+  def _spans(self, n):
+    lo, hi = self._lengths(n)
+    return [(s, s+k) for k in range(lo, hi+1) for s in range(n-k+1)]
+
+  def _ngram_strings(self, res, prefix, suffix):
+    # The lo-grams are joined directly, then each k-gram is built from the (k-1)-grams, by
+    # increasing length (i.e. in output order)
+    lo, hi = self._lengths(len(res))
+    if hi < lo:
+      return []
+    grams = res if lo == 1 else [' '.join(res[s:s+lo]) for s in range(len(res)-lo+1)]
+    out = [prefix + g + suffix for g in grams]
+    for k in range(lo+1, hi+1):
+      grams = [grams[s] + ' ' + res[s+k-1] for s in range(len(res)-k+1)]
+      out.extend([prefix + g + suffix for g in grams])
+    return out
+
+
+class RightNgrams(_NgramIndicator):
   """Return all the ngrams which start at position 0"""
-  def _get_features(self, res):
-    return [' '.join(res[:l]) for l in range(1, len(res)+1)]
+  def _spans(self, n):
+    return [(0, l) for l in range(1, n+1)]
+
+  def _ngram_strings(self, res, prefix, suffix):
+    out = []
+    g = prefix + res[0]
+    out.append(g + suffix)
+    for t in res[1:]:
+      g = g + ' ' + t
+      out.append(g + suffix)
+    return out
     
 
-class LeftNgrams(Indicator):
+class LeftNgrams(_NgramIndicator):
   """Return all the ngrams which start at position 0"""
-  def _get_features(self, res):
-    return [' '.join(res[l:]) for l in range(len(res))]
+  def _spans(self, n):
+    return [(l, n) for l in range(n)]
+
+  def _ngram_strings(self, res, prefix, suffix):
+    # Build the suffixes from the end, then reverse into output (longest first) order
+    out = []
+    g = res[-1] + suffix
+    out.append(prefix + g)
+    for t in reversed(res[:-1]):
+      g = t + ' ' + g
+      out.append(prefix + g)
+    return out[::-1]
     
 
-class Regexp(Indicator):
+# Length of the literal substrings (n-grams) that RegexMatcher keys regexes by
+RGX_GRAM = 3
+
+_REPEATS = tuple(getattr(sre_parse, op) for op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, op))
+
+def _regex_keys(parsed, cost, ci=False):
+  """The n-gram keys of a parsed regex (see regex_keys)"""
+  keys = []
+  run = []
+  for op, av in list(parsed) + [(None, None)]:
+    if op == sre_parse.LITERAL:
+      run.append(chr(av))
+      continue
+
+    # A run of literals: each of its n-grams is required
+    lit = ''.join(run)
+    run = []
+    if ci:
+      lit = lit.lower() if lit.isascii() else ''
+    keys.extend({lit[i:i+RGX_GRAM]} for i in range(len(lit) - RGX_GRAM + 1))
+
+    # Groups & repeats (of at least one) must match their contents; alternations one of theirs
+    if op == sre_parse.SUBPATTERN and (ci or not av[1] & re.IGNORECASE):
+      keys.extend(_regex_keys(av[-1], cost, ci))
+    elif op in _REPEATS and av[0] >= 1:
+      keys.extend(_regex_keys(av[2], cost, ci))
+    elif op == sre_parse.BRANCH:
+      alts = [_regex_keys(p, cost, ci) for p in av[1]]
+      if all(len(a) > 0 for a in alts):
+        keys.append(set().union(*(min(a, key=lambda k : key_cost(k, cost)) for a in alts)))
+  return keys
+
+def key_cost(key, cost):
+  """The cost of a set of n-grams (see regex_keys): the total cost of its n-grams, then its size"""
+  return (sum(cost(g) for g in key), len(key))
+
+def regex_keys(rgx, cost=None):
+  """
+  Get (conservatively) the n-gram keys of a compiled regex: a list of sets of n-grams, such that
+  any match of the regex contains at least one n-gram of *each* set; [] if there are none
+  Within alternations, the keys of least key_cost by cost(n-gram) are used. Case-insensitive
+  regexes get lowercased keys, from just their ascii literals
+  """
+  if not isinstance(rgx.pattern, str):
+    return []
+  try:
+    parsed = sre_parse.parse(rgx.pattern, rgx.flags)
+  except Exception:
+    return []
+  keys = _regex_keys(parsed, cost or (lambda g : 0), rgx.flags & re.IGNORECASE != 0)
+  return list(map(set, OrderedDict.fromkeys(frozenset(k) for k in keys)))
+
+
+class RegexMatcher:
+  """
+  A bank of (regex, label) pairs, for finding all the regexes which match a string in one pass
+  Each regex is keyed by n-grams one of which any match of it must contain (see regex_keys), so
+  that only the regexes whose keys occur in the string are run; the cost of a scan then grows
+  with the length of the string rather than with the number of regexes. Regexes without such
+  literals are always run. Case-insensitive regexes are keyed by lowercased ascii n-grams
+  Build this once per bank & share it across RegexpBank templates
+  """
+  def __init__(self, patterns):
+    self.patterns = [(rgx, label) for rgx, label in patterns]
+    self.labels = [label for _, label in self.patterns]
+    self._compiled = [re.compile(rgx) for rgx, _ in self.patterns]
+    self._index = {}
+    self._index_ci = {}
+    self._ci = []
+    self._always = []
+    for k, rgx in enumerate(self._compiled):
+      ci = rgx.flags & re.IGNORECASE != 0
+      index = self._index_ci if ci else self._index
+      cost = lambda g : len(index.get(g, ()))
+      keys = regex_keys(rgx, cost)
+      if len(keys) == 0:
+        self._always.append(k)
+        continue
+
+      # Key by the least shared n-grams, to keep the candidate lists short
+      for g in min(keys, key=lambda k : key_cost(k, cost)):
+        index.setdefault(g, []).append(k)
+      if ci:
+        self._ci.append(k)
+
+  def __len__(self):
+    return len(self.patterns)
+
+  def _candidates(self, text, index, cands):
+    n = RGX_GRAM
+    for g in set(text[i:i+n] for i in range(len(text) - n + 1)):
+      ks = index.get(g)
+      if ks is not None:
+        cands.update(ks)
+
+  def match(self, text):
+    """Get the indexes (in bank order) of the regexes which match (i.e. re.search) text"""
+    cands = set(self._always)
+    if len(self._index) > 0:
+      self._candidates(text, self._index, cands)
+    if len(self._index_ci) > 0:
+      if text.isascii():
+        self._candidates(text.lower(), self._index_ci, cands)
+      else:
+        cands.update(self._ci)
+    return [k for k in sorted(cands) if self._compiled[k].search(text) is not None]
+
+  def __repr__(self):
+    return '<%s: %d patterns>' % (self.__class__.__name__, len(self))
+
+
+class RegexpBank(Indicator):
+  """
+  Return an RGX:<label> indicator feature for each of a bank of (regex, label) pairs which
+  matches the concatenation of the result set strings- as a Regexp per pair would, but with a
+  single scan of the string (see RegexMatcher)
+  The concatenated string is also shared (via the memo) by all RegexpBank & Regexp templates
+  over the same node set & attributes, for the same candidate
+  """
+  def __init__(self, ns, attribs, patterns, sep=' '):
+    self.ns = ns
+    self.attribs = attribs
+    self.matcher = patterns if isinstance(patterns, RegexMatcher) else RegexMatcher(patterns)
+    self.sep = sep
+    self.psort = 'word_idx' # Sort by word order...
+
+  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, inv_tag=True, stopwords=None, dict_sub={}, memo=None, prof=None):
+    inv = 'INV_' if inv_tag and len(cids) == 2 and cids[0][0] > cids[1][0] else ''
+    key = ('rgx-text', self.ns.xpath, getattr(self.ns, 'seq_attrib', None), cid_attrib, self.attribs, self.sep, tuple(map(tuple, cids)))
+    if memo is not None and key in memo:
+      text = memo[key]
+    else:
+      res, _ = self._result(root, cids, cid_attrib, inv, stopwords, dict_sub, memo, prof)
+      text = self.sep.join(res) if len(res) > 0 else None
+      if memo is not None:
+        memo[key] = text
+    if text is not None:
+      feats = self._match_features(text)
+      if feat_label:
+        label = self._label(inv)[1]
+        feats = ('%s[%s]' % (label, feat) for feat in feats)
+      for feat in feats:
+        yield feat
+
+  def _get_features(self, res):
+    return self._match_features(self.sep.join(res))
+
+  def _match_features(self, text):
+    labels = OrderedDict.fromkeys(self.matcher.labels[k] for k in self.matcher.match(text))
+    return ['RGX:%s' % label for label in labels]
+
+  def __repr__(self):
+    return '<%s:%s:%s:%d patterns, xpath="%s">' % (self.__class__.__name__, self.attribs, self.ns.label, len(self.matcher), self.ns.xpath)
+
+
+class Regexp(RegexpBank):
   """
   Return indicator features if the regular expression applied to the 
   concatenation of the result set strings is not None
+  For many regexes over the same node set, use a RegexpBank instead
   """
   def __init__(self, ns, attribs, rgx, rgx_label, sep=' '):
     self.ns = ns
@@ -262,10 +846,15 @@ class Regexp(Indicator):
     self.sep = sep
     self.psort = 'word_idx' # Sort by word order...
 
-  def _get_features(self, res):
-    match = re.search(self.rgx, self.sep.join(res))
-    if match is not None:
-      yield 'RGX:%s' % self.rgx_label
+  def _match_features(self, text):
+    # Note: compiled once, & kept out of the public attributes (i.e. the template fingerprint)
+    rgx = self.__dict__.get('_rgx')
+    if rgx is None:
+      rgx = self.__dict__['_rgx'] = re.compile(self.rgx)
+    return ['RGX:%s' % self.rgx_label] if rgx.search(text) is not None else []
+
+  def __repr__(self):
+    return Indicator.__repr__(self)
 
 
 class LengthBin(Indicator):
@@ -294,57 +883,116 @@ class LengthBin(Indicator):
       lbin = (self.bins[-1][1]+1, 'inf')
     yield 'LEN:%s-%s' % lbin
 
+  def __repr__(self):
+    return '<%s:%s:%s, xpath="%s">' % (self.__class__.__name__, self.bins, self.ns.label, self.ns.xpath)
+
+
+class PhraseMatcher:
+  """
+  A token-level Aho-Corasick automaton over a dictionary of phrases (tokenized on whitespace),
+  for finding all the (possibly overlapping) phrase matches in a token sequence in one pass
+  Build this once per dictionary & share it across DictionaryIntersect templates
+  """
+  def __init__(self, phrases, caseless=True):
+    self.caseless = caseless
+    self.goto = [{}]
+    self.out = [0]  # Length of the longest phrase ending at each state, incl. via fail links
+
+    # Build the trie
+    for phrase in phrases:
+      s = 0
+      toks = (phrase.lower() if caseless else phrase).split()
+      for t in toks:
+        if t not in self.goto[s]:
+          self.goto[s][t] = len(self.goto)
+          self.goto.append({})
+          self.out.append(0)
+        s = self.goto[s][t]
+      if len(toks) > 0:
+        self.out[s] = len(toks)
+
+    # Add the failure links, breadth-first
+    self.fail = [0] * len(self.goto)
+    queue = deque(self.goto[0].values())
+    while len(queue) > 0:
+      s = queue.popleft()
+      for t, ns in self.goto[s].items():
+        f = self.fail[s]
+        while f > 0 and t not in self.goto[f]:
+          f = self.fail[f]
+        self.fail[ns] = self.goto[f].get(t, 0)
+        self.out[ns] = max(self.out[ns], self.out[self.fail[ns]])
+        queue.append(ns)
+
+  def match(self, tokens):
+    """Get the set of indexes of tokens which are part of some dictionary phrase match"""
+    res = set()
+    s = 0
+    for i,t in enumerate(tokens):
+      if t is None:
+        s = 0
+        continue
+      if self.caseless:
+        t = t.lower()
+      while s > 0 and t not in self.goto[s]:
+        s = self.fail[s]
+      s = self.goto[s].get(t, 0)
+
+      # All matches end here, so their union is just the longest one
+      if self.out[s] > 0:
+        res.update(range(i - self.out[s] + 1, i + 1))
+    return res
+
+  def __len__(self):
+    return len(self.goto)
+
 
-# TODO: Make this way more efficient...?
 class DictionaryIntersect(Indicator):
   """
   Return an indicator feature for whether the input nodeset intersects with any phrase in
   the given dictionary
+  The dictionary d can be a list of phrases, or a prebuilt PhraseMatcher
   """
   def __init__(self, ns, d_name, d, d_attrib='word', caseless=True):
     self.ns = ns
     self.d_name = d_name
     self.d_attrib = d_attrib
-    self.caseless = caseless
-
-    # Split the dictionary up by phrase length (i.e. # of tokens)
-    self.dl = defaultdict(lambda : set())
-    for phrase in d:
-      if caseless:
-        phrase = phrase.lower()
-      self.dl[len(phrase.split())].add(phrase)
-    self.dl.update((k, frozenset(v)) for k,v in self.dl.items())
-
-    # Get the ngram range for this dictionary
-    self.ng_range = range(max(1, min(self.dl.keys())), max(self.dl.keys())+1)
+    self.matcher = d if isinstance(d, PhraseMatcher) else PhraseMatcher(d, caseless=caseless)
+    self.caseless = self.matcher.caseless
 
-  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True):
+  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, dict_sub={}, stopwords=None, memo=None, prof=None):
     """
     We replace the default apply method because we first need to get the full sequence,
     match against ngrams of this, then math via cid_attrib against the input NodeSet
     We do this because we need to catch e.g. when a multi-word phrase in the dictionary
     only partially-overlaps with the NodeSet (this should count as a match!)
+    Note that neither of these first two steps depend on the candidate, so are memoized
     """
+    memo = {} if memo is None else memo
+    get = node_getter(root)
+
     # First get full sequence
-    fs = list(map(lambda x : x.get(self.d_attrib), sorted(root.xpath("//*[@word_idx]"), key=lambda x : int(x.get('word_idx')))))
-
-    # Next do sequence n-gram matching
-    dcids = set()
-    for l in self.ng_range:
-      for i in range(0, len(fs)-l+1):
-        phrase = ' '.join(fs[i:i+l]).lower() if self.caseless else ' '.join(fs[i:i+l])
-        if phrase in self.dl[l]:
-          dcids.update(range(i, i+l))
-
-    # Finally, just look for intersect via XPATH + using the super method
-    # TODO: How to call parent method here!?
-    if len(dcids) > 0:
-      self.ns.xpath += '[' + " or ".join("@word_idx='%s'" % i for i in dcids) + ']'
-      m = [" or ".join("@%s='%s'" % (cid_attrib, c) for c in cid) for cid in cids] 
-      xpath = self.ns.xpath.format(*m)
-      if len(root.xpath(xpath)) > 0:
+    key = ('dict-seq', self.d_attrib)
+    if key not in memo:
+      seq = sentence_nodes(root, memo=memo)
+      memo[key] = ([get(n, 'word_idx') for n in seq], [get(n, self.d_attrib) for n in seq])
+    widxs, fs = memo[key]
+
+    # Next do sequence phrase matching, mapping back from sequence position -> word_idx
+    key = ('dict-match', id(self.matcher), self.d_attrib)
+    if key not in memo:
+      memo[key] = frozenset(widxs[i] for i in self.matcher.match(fs))
+    dwidxs = memo[key]
+
+    # Finally, just look for intersect with the NodeSet
+    # Note: we don't touch any shared state here, so this is safe to reuse & share across threads
+    if len(dwidxs) > 0:
+      if any(get(n, 'word_idx') in dwidxs for n in self._get_nodes(root, cids, cid_attrib, memo=memo, prof=prof)):
         yield "DICTIONARY-MATCH:%s:%s" % (self.d_name, self.ns.label)
 
+  def __repr__(self):
+    return '<%s:%s:%s:%s, xpath="%s">' % (self.__class__.__name__, self.d_name, self.d_attrib, self.ns.label, self.ns.xpath)
+
 
 # COMBINATOR:
 # ===========
@@ -353,25 +1001,44 @@ class Combinator:
   """
   Combinator objects are functions f : {0,1}^F x {0,1}^F -> {0,1}^F
   ---------------
-  Combinator objects take two (or more?) Indicator objects and map to feature space
+  Combinator objects take two (or more) Indicator objects and map to feature space
   """
-  def __init__(self, ind1, ind2):
+  def __init__(self, ind1, ind2, *inds):
     self.ind1 = ind1
     self.ind2 = ind2
+    self.inds = (ind1, ind2) + inds
 
-  def apply(self, root, cids, cid_attrib='word_idx', dict_sub={}, stopwords=None):
-    return self.ind1.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords)
+  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, dict_sub={}, stopwords=None, memo=None, prof=None):
+    return self.ind1.apply(root, cids, cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords, memo=memo, prof=prof)
 
   def print_apply(self, root, cids, cid_attrib='word_idx', dict_sub={}, stopwords=None):
     return self.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords)
+
+  def __repr__(self):
+    return '<%s:%s>' % (self.__class__.__name__, '+'.join(str(ind) for ind in self.inds))
   
 
 class Combinations(Combinator):
-  """Generates all *pairs* of features"""
-  def apply(self, root, cids, cid_attrib='word_idx', dict_sub={}, stopwords=None):
-    for f1 in self.ind1.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords):
-      for f2 in self.ind2.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords):
-        yield '%s+%s' % (f1, f2)
+  """
+  Generates all combinations (i.e. the cross product) of features of the child Indicators, e.g.
+  all pairs for Combinations(ind1, ind2)
+  Each child is applied just once; optionally at most max_features combinations are generated
+  """
+  def __init__(self, ind1, ind2, *inds, max_features=None):
+    Combinator.__init__(self, ind1, ind2, *inds)
+    for ind in self.inds:
+      if getattr(ind, 'output', 'str') != 'str':
+        raise ValueError("Combinations need string features, but %s has output='%s'" % (ind, ind.output))
+    self.max_features = max_features
+
+  def apply(self, root, cids, cid_attrib='word_idx', feat_label=True, dict_sub={}, stopwords=None, memo=None, prof=None):
+    fs = []
+    for ind in self.inds:
+      fs.append(list(ind.apply(root, cids, cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords, memo=memo, prof=prof)))
+      if len(fs[-1]) == 0:
+        return
+    for f in islice(product(*fs), self.max_features):
+      yield '+'.join(f)
 
 
 # Compile Operator: Compiles a set of feature templates
@@ -382,9 +1049,14 @@ class Compile:
   Compiles a set of functions f_i : 2^T -> {0,1}^F_i to a single function 2^T -> {0,1}^F
   where F <= \sum_i F_i
   i.e. we can do filtering and/or merging at this point (?)
+  If profile=True, per-operator timings & counts are collected in self.profiler (see Profiler)
+  If a hasher (e.g. a FeatureHasher) is provided, integer feature ids are output rather than
+  feature strings
   """
-  def __init__(self, op_list):
+  def __init__(self, op_list, profile=False, hasher=None):
     self.op_list = op_list
+    self.profiler = Profiler() if profile else None
+    self.hasher = hasher
   
   def _iterops(self):
     """Iterate over the operators provided, accepting list of single or list elements"""
@@ -406,9 +1078,50 @@ class Compile:
       root = et.fromstring(root)
 
     # Apply the feature templates
-    for op in self._iterops():
-      for f in op.apply(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords):
+    fs = self._apply_ops(root, cids, cid_attrib, dict_sub, stopwords)
+    return fs if self.hasher is None else map(self.hasher, fs)
+
+  def _apply_ops(self, root, cids, cid_attrib='word_idx', dict_sub={}, stopwords=None, memo=None, feat_label=True):
+    """
+    Apply each of the operators to a single candidate
+    The operators share a memo, so that common node sets are only evaluated once (see shared_nodes)
+    """
+    memo = {} if memo is None else memo
+    if self.profiler is None:
+      for op in self._iterops():
+        for f in op.apply(root, cids, cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords, memo=memo):
+          yield f
+      return
+
+    # If profiling, we consume each operator's features before yielding them, so that the
+    # timings don't include the caller's time
+    for i, op in enumerate(self._iterops()):
+      prof = self.profiler.op(i, op)
+      t = perf_counter()
+      fs = list(op.apply(root, cids, cid_attrib, feat_label=feat_label, dict_sub=dict_sub, stopwords=stopwords, memo=memo, prof=prof))
+      prof.wall += perf_counter() - t
+      prof.calls += 1
+      prof.features += len(fs)
+      for f in fs:
         yield f
+
+  def apply_batch(self, root, cands, cid_attrib='word_idx', dict_sub={}, stopwords=None):
+    """
+    Apply the feature templates to a batch of candidates in the same sentence, where cands
+    is a list of candidates, each a list of lists of candidate mention ids (i.e. cids)
+    Sentence-level work is done just once per batch, rather than once per candidate
+    Yields (candidate index, feature) pairs
+    """
+    # Ensure that root is parsed
+    if type(root) == str:
+      root = et.fromstring(root)
+
+    # Apply the feature templates, sharing a memo across candidates
+    memo = {}
+    h = self.hasher
+    for k, cids in enumerate(cands):
+      for f in self._apply_ops(root, cids, cid_attrib, dict_sub, stopwords, memo):
+        yield k, (f if h is None else h(f))
   
   def result_set(self, root, cids, cid_attrib='word_idx', dict_sub={}, stopwords=None):
     """Takes the union of the result sets"""
@@ -416,11 +1129,9 @@ class Compile:
     if type(root) == str:
       root = et.fromstring(root)
 
-    # Apply the feature templates
-    res = set()
-    for op in self._iterops():
-      res.update(op.result_set(root, cids, cid_attrib, dict_sub=dict_sub, stopwords=stopwords))
-    return res
+    # Apply the feature templates, unlabeled as for Indicator.result_set
+    res = set(self._apply_ops(root, cids, cid_attrib, dict_sub, stopwords, feat_label=False))
+    return res if self.hasher is None else set(map(self.hasher, res))
   
   def apply_mention(self, root, mention_idxs, dict_sub={}, stopwords=None):
     return self.apply(root, [mention_idxs], dict_sub=dict_sub, stopwords=stopwords)
@@ -430,6 +1141,15 @@ class Compile:
   
   def apply_multary_relation(self, root, mentions, dict_sub={}, stopwords=None):
     return self.apply(root, mentions, dict_sub=dict_sub, stopwords=stopwords)
+
+  def apply_mentions(self, root, mentions_idxs, dict_sub={}, stopwords=None):
+    return self.apply_batch(root, [[m] for m in mentions_idxs], dict_sub=dict_sub, stopwords=stopwords)
+
+  def apply_relations(self, root, relations_idxs, dict_sub={}, stopwords=None):
+    return self.apply_batch(root, [[m1, m2] for m1, m2 in relations_idxs], dict_sub=dict_sub, stopwords=stopwords)
+
+  def apply_multary_relations(self, root, relations_mentions, dict_sub={}, stopwords=None):
+    return self.apply_batch(root, relations_mentions, dict_sub=dict_sub, stopwords=stopwords)
   
   def __repr__(self):
     return '\n'.join(str(op) for op in self._iterops())
@@ -1,4 +1,4 @@
-from collections import namedtuple
+from functools import lru_cache
 import re
 import sys
 
@@ -23,44 +23,154 @@ TYPE_PARSERS = {
   'text' : lambda x : str(x.replace('\n', ' ')),
   'int' : lambda x : int(x.strip()),
   'float' : lambda x : float(x.strip()),
-  'boolean' : lambda x : BOOL_PARSER(x.lower().strip())
+  'boolean' : lambda x : BOOL_PARSER[x.strip() if x.strip() in BOOL_PARSER else x.strip().lower()[:1]]
 }
 
+# Postgres COPY (text format) escapes, e.g. \t, \n, \\, octal \NNN and hex \xHH
+COPY_ESCAPES = {'b' : '\b', 'f' : '\f', 'n' : '\n', 'r' : '\r', 't' : '\t', 'v' : '\v'}
+COPY_ESCAPE_RGX = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))', flags=re.S)
+
+def _copy_unescape(m):
+  o, x, c = m.groups()
+  if o is not None:
+    return chr(int(o, 8))
+  elif x is not None:
+    return chr(int(x, 16))
+  return COPY_ESCAPES.get(c, c)
+
+def copy_unescape(s):
+  """Undo the escaping of a field in Postgres COPY text format"""
+  return COPY_ESCAPE_RGX.sub(_copy_unescape, s) if '\\' in s else s
+
+# Tokens of a postgres {-format array: a quoted element, a brace or comma, or an unquoted element
+PG_ARRAY_TOKEN_RGX = re.compile(r'"((?:[^"\\]|\\.)*)"|([{},])|((?:[^{},"\\]|\\.)+)', flags=re.S)
+PG_ARRAY_ESCAPE_RGX = re.compile(r'\\(.)', flags=re.S)
+
+def parse_pg_array(s, parse=str):
+  """
+  Parse a postgres {-format array string (e.g. {"a","b"}, possibly nested) in a single pass,
+  applying parse to each (unquoted & unescaped) element
+  """
+  # Fast path for the common case where every element is quoted & nothing is escaped
+  if s.startswith('{"') and s.endswith('"}') and '\\' not in s:
+    split = s[2:-2].split('","')
+    if s.count('"') == 2 * len(split):
+      return [parse(x) for x in split]
+
+  # ... or where no element is quoted or escaped, and there is no nesting (e.g. numeric arrays)
+  elif s.startswith('{') and s.endswith('}') and '"' not in s and '\\' not in s and s.count('{') == 1:
+    split = s[1:-1].split(',')
+    if len(split) == 1 and len(split[0].strip()) == 0:
+      return []
+    return [None if x.strip().upper() == 'NULL' else parse(x.strip()) for x in split]
+
+  res = None
+  stack = []
+  for m in PG_ARRAY_TOKEN_RGX.finditer(s):
+    quoted, brace, unquoted = m.groups()
+    if brace == '{':
+      stack.append([])
+    elif brace == '}':
+      if len(stack) == 0:
+        raise ValueError("Unbalanced braces in array: %s" % s)
+      arr = stack.pop()
+      if len(stack) > 0:
+        stack[-1].append(arr)
+      else:
+        res = arr
+    elif brace == ',':
+      continue
+    elif len(stack) == 0:
+      raise ValueError("Malformed array: %s" % s)
+    elif quoted is not None:
+      stack[-1].append(parse(PG_ARRAY_ESCAPE_RGX.sub(r'\1', quoted) if '\\' in quoted else quoted))
+    else:
+      unquoted = unquoted.strip()
+      if len(unquoted) == 0:
+        continue
+      elif unquoted.upper() == 'NULL':
+        stack[-1].append(None)
+      else:
+        stack[-1].append(parse(PG_ARRAY_ESCAPE_RGX.sub(r'\1', unquoted) if '\\' in unquoted else unquoted))
+  if res is None or len(stack) > 0:
+    raise ValueError("Malformed array: %s" % s)
+  return res
+
+def _compile_element_parser(t, sep='|^|', sep2='|~|'):
+  """Compile a parser for an (already COPY-unescaped) element of type t"""
+  # Handle lists first
+  if t.endswith('[]'):
+    base = t
+    while base.endswith('[]'):
+      base = base[:-2]
+    parse_base = _compile_element_parser(base)
+    parse_sub = _compile_element_parser(t[:-2], sep=sep2, sep2=sep2)
+    def parse(s):
+      if len(s) == 0 or s == '\\N':
+        return None
+      elif s[0] == '{':
+        return parse_pg_array(s, parse_base)
+      return [parse_sub(ss) for ss in s.split(sep)]
+    return parse
+
+  # Else parse using parser
+  try:
+    parser = TYPE_PARSERS[t]
+  except KeyError:
+    raise Exception("Unsupported type: %s" % t)
+  def parse(s):
+    if len(s) == 0 or s == '\\N':
+      return None
+    return parser(s)
+  return parse
+
+@lru_cache(maxsize=None)
+def compile_ptsv_parser(t, sep='|^|', sep2='|~|'):
+  """
+  Compile (once) a parser function for elements in psql-compatible tsv format, i.e. {-format
+  arrays, based on the provided type and type-parser dictionary
+  """
+  parse = _compile_element_parser(t, sep=sep, sep2=sep2)
+  def parse_field(s):
+    # Interpret null first regardless of type
+    if s == '\\N':
+      return None
+    return parse(copy_unescape(s))
+  return parse_field
+
 def parse_ptsv_element(s, t, sep='|^|', sep2='|~|'):
   """
   Parse an element in psql-compatible tsv format, i.e. {-format arrays
   based on provided type and type-parser dictionary
   """
-  # Interpret null first regardless of type
-  if len(s) == 0 or s == '\\N':
-    return None
-
-  # Handle lists recursively first
-  elif '[]' in t:
-    if re.search(r'^\{|\}$', s):
-      split = re.split(r'\"?\s*,\s*\"?', re.sub(r'^\{\s*\"?|\"?\s*\}$', '', s))
-    else:
-      split = s.split(sep)
-    return [parse_ptsv_element(ss, t[:-2], sep=sep2) for ss in split]
-  
-  # Else parse using parser 
-  else:
-    try:
-      parser = TYPE_PARSERS[t]
-    except KeyError:
-      raise Exception("Unsupported type: %s" % t)
-    return parser(s)
+  return compile_ptsv_parser(t, sep=sep, sep2=sep2)(s)
 
 
 class Row:
+  """
+  Base class of parsed rows: PTSVParser makes a subclass of this per schema, with a slot per
+  field- or an instance dict, if the field names can't all be slots (see row_class)
+  """
+  __slots__ = ()
+  _row_fields = ()
+
   def __str__(self):
-    return '<Row(' + ', '.join("%s=%s" % x for x in self.__dict__.items()) + ')>'
+    return '<Row(' + ', '.join("%s=%s" % x for x in Row._asdict(self).items()) + ')>'
 
   def __repr__(self):
     return str(self)
 
   def _asdict(self):
-    return self.__dict__
+    return dict((k, getattr(self, k, None)) for k in type(self)._row_fields)
+
+def row_class(names):
+  """Make a Row class with the given fields, slotted if they are all (non-private) identifiers"""
+  fields = tuple(dict.fromkeys(names))
+  if all(n.isidentifier() and not n.startswith('__') and not hasattr(Row, n) for n in fields):
+    slots = fields
+  else:
+    slots = ('__dict__',)
+  return type('Row', (Row,), {'__slots__' : slots, '_row_fields' : fields})
 
 
 class PTSVParser:
@@ -68,19 +178,22 @@ class PTSVParser:
   Initialized with a list of duples (field_name, field_type)
   Is a factory for simple Row class
   Parsed from Postgres-style TSV input lines
+  The field parsers & Row class are made just once, on initialization
   """
   def __init__(self, fields):
     self.fields = fields
     self.n = len(fields)
+    self.names = [field_name for field_name, field_type in fields]
+    self.parsers = [compile_ptsv_parser(field_type) for field_name, field_type in fields]
+    self.row_class = row_class(self.names)
 
   def parse_line(self, line):
-    row = Row()
-    attribs = line.rstrip().split('\t')
+    attribs = line.rstrip('\r\n').split('\t')
     if len(attribs) != self.n:
       raise ValueError("%s attributes for %s fields:\n%s" % (len(attribs), self.n, line))
-    for i,attrib in enumerate(attribs):
-      field_name, field_type = self.fields[i]
-      setattr(row, field_name, parse_ptsv_element(attrib, field_type))
+    row = self.row_class()
+    for name, parse, attrib in zip(self.names, self.parsers, attribs):
+      setattr(row, name, parse(attrib))
     return row
 
   def parse_stdin(self):
@@ -88,26 +201,56 @@ class PTSVParser:
       yield self.parse_line(line)
 
 
+def copy_escape(s):
+  """Escape a field for Postgres COPY text format (backslashes, tabs & line breaks)"""
+  if '\\' in s:
+    s = s.replace('\\', '\\\\')
+  if '\t' in s or '\n' in s or '\r' in s:
+    s = s.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+  return s
+
 def pg_array_escape(tok):
   """
   Escape a string that's meant to be in a Postgres array.
   We double-quote the string and escape backslashes and double-quotes.
   """
-  return '"%s"' % str(tok).replace('\\', '\\\\').replace('"', '\\\\"')
+  return '"%s"' % str(tok).replace('\\', '\\\\').replace('"', '\\"')
+
+_PG_ARRAY_SCALARS = frozenset([str, int, float, bool])
 
 def list_to_pg_array(l):
-  """Convert a list to a string that PostgreSQL's COPY FROM understands."""
-  return '{%s}' % ','.join(pg_array_escape(x) for x in l)
+  """
+  Convert a list to a Postgres {-format array string (which is then COPY escaped as a field).
+  The elements are joined first, so that the common case- a flat list of strings or numbers-
+  is checked & escaped in one pass over the whole array, not per element. None elements are
+  written as NULL, and nested lists or tuples as nested arrays
+  """
+  if len(l) == 0:
+    return '{}'
+  if not _PG_ARRAY_SCALARS.issuperset(map(type, l)):
+    return '{%s}' % ','.join('NULL' if x is None else list_to_pg_array(x) if isinstance(x, (list, tuple))
+                             else pg_array_escape(x) for x in l)
+  # Note: elements can't contain NUL (Postgres text can't), so it can stand in for the separator
+  s = '\x00'.join([x if type(x) is str else str(x) for x in l])
+  if '\\' in s or '"' in s:
+    s = s.replace('\\', '\\\\').replace('"', '\\"')
+  return '{"%s"}' % s.replace('\x00', '","')
 
-def print_tsv(out_record):
-  """Print a tuple as output of TSV extractor."""
+def format_tsv(out_record):
+  """Format a tuple as a line of TSV extractor output, i.e. in Postgres COPY text format."""
   values = []
   for x in out_record:
     if isinstance(x, list) or isinstance(x, tuple):
-      cur_val = list_to_pg_array(x)
+      cur_val = copy_escape(list_to_pg_array(x))
     elif x is None:
       cur_val = r'\N'
+    elif isinstance(x, str):
+      cur_val = copy_escape(x)
     else:
-      cur_val = x
+      cur_val = str(x)
     values.append(cur_val)
-  print('\t'.join(str(x) for x in values))
+  return '\t'.join(values)
+
+def print_tsv(out_record):
+  """Print a tuple as output of TSV extractor."""
+  print(format_tsv(out_record))
@@ -0,0 +1,200 @@
+from array import array
+
+
+def _numpy():
+  """Import numpy on first use, as it is slow to load & only needed for the matrix export"""
+  try:
+    import numpy
+  except ImportError:
+    raise ImportError("numpy is required for sparse matrix export")
+  return numpy
+
+
+class FeatureVocabulary:
+  """
+  Interns features (e.g. feature strings) to dense integer ids, in order of first appearance
+  Document frequencies are counted as features are added; freeze() then drops the features
+  seen in fewer than min_count rows, compacts the ids and fixes the vocabulary, after which
+  unknown features are ignored (e.g. for inference-time extraction)
+  """
+  def __init__(self, min_count=1):
+    self.min_count = min_count
+    self.ids = {}
+    self.features = []
+    self.counts = array('q')
+    self.frozen = False
+
+  def __len__(self):
+    return len(self.features)
+
+  def __contains__(self, feature):
+    return feature in self.ids
+
+  def get(self, feature):
+    """Get the id of a feature, or None if not in the vocabulary"""
+    return self.ids.get(feature)
+
+  def add(self, feature, count=1):
+    """Get the id of a feature, adding it (if not frozen) and incrementing its count"""
+    fid = self.ids.get(feature)
+    if fid is None:
+      if self.frozen:
+        return None
+      fid = self.ids[feature] = len(self.features)
+      self.features.append(feature)
+      self.counts.append(0)
+    if not self.frozen:
+      self.counts[fid] += count
+    return fid
+
+  def add_row(self, features):
+    """Add the (distinct) features of a single row, getting their sorted ids"""
+    ids = set()
+    for f in features:
+      fid = self.ids.get(f)
+      if fid is None and not self.frozen:
+        fid = self.ids[f] = len(self.features)
+        self.features.append(f)
+        self.counts.append(0)
+      if fid is not None:
+        ids.add(fid)
+    if not self.frozen:
+      for fid in ids:
+        self.counts[fid] += 1
+    return sorted(ids)
+
+  def freeze(self, min_count=None):
+    """
+    Drop features with count < min_count, compact the ids and freeze the vocabulary
+    Returns an array mapping old ids -> new ids, or -1 for features dropped
+    """
+    min_count = self.min_count if min_count is None else min_count
+    remap = array('i', [-1]) * len(self.features)
+    features, counts = [], array('q')
+    for i, (f, c) in enumerate(zip(self.features, self.counts)):
+      if c >= min_count:
+        remap[i] = len(features)
+        features.append(f)
+        counts.append(c)
+    self.features = features
+    self.counts = counts
+    self.ids = dict((f, i) for i, f in enumerate(features))
+    self.frozen = True
+    return remap
+
+  # Header line of saved vocabularies, giving the type of the features
+  HEADER = '#treedlib-vocab\t%s'
+  TYPES = {'str' : str, 'int' : int}
+
+  def save(self, path):
+    """
+    Write the vocabulary as TSV (feature, count) lines, in id order, after a header line with
+    the type of the features: str, or int for hashed features (see FeatureHasher)
+    """
+    types = set(map(type, self.features))
+    if types.issubset([str]):
+      t = 'str'
+    elif types == set([int]):
+      t = 'int'
+    else:
+      raise ValueError("Only vocabularies of all str or all int features can be saved, not %s"
+                       % sorted(x.__name__ for x in types))
+    with open(path, 'w') as f:
+      f.write(self.HEADER % t + '\n')
+      for feat, c in zip(self.features, self.counts):
+        f.write('%s\t%d\n' % (feat, c))
+
+  @classmethod
+  def load(cls, path, frozen=True):
+    """Load a vocabulary written by save (files without the header line have str features)"""
+    v = cls()
+    parse = str
+    with open(path) as f:
+      for k, line in enumerate(f):
+        line = line.rstrip('\n')
+        if k == 0 and line.startswith(cls.HEADER % ''):
+          parse = cls.TYPES[line[len(cls.HEADER % ''):]]
+          continue
+        feat, c = line.rsplit('\t', 1)
+        feat = parse(feat)
+        v.ids[feat] = len(v.features)
+        v.features.append(feat)
+        v.counts.append(int(c))
+    v.frozen = frozen
+    return v
+
+  def __repr__(self):
+    return '<%s: %d features%s>' % (self.__class__.__name__, len(self), ', frozen' if self.frozen else '')
+
+
+class SparseFeatureMatrix:
+  """
+  A binary (candidates x features) matrix in CSR form: the feature ids of row i are
+  indices[indptr[i]:indptr[i+1]], sorted
+  """
+  def __init__(self, indptr, indices, n_cols):
+    self.indptr = indptr
+    self.indices = indices
+    self.shape = (len(indptr) - 1, n_cols)
+
+  @property
+  def nnz(self):
+    return len(self.indices)
+
+  def row(self, i):
+    return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+  def save_npz(self, path):
+    """Save to .npz, in the same layout as scipy.sparse.save_npz (so scipy.sparse.load_npz works)"""
+    np = _numpy()
+    np.savez(path, indptr=self.indptr, indices=self.indices, data=np.ones(self.nnz, dtype=np.int8),
+             shape=np.array(self.shape), format=np.array(b'csr'))
+
+  @classmethod
+  def load_npz(cls, path):
+    np = _numpy()
+    with np.load(path) as d:
+      return cls(d['indptr'], d['indices'], int(d['shape'][1]))
+
+  def to_scipy(self):
+    from scipy.sparse import csr_matrix
+    np = _numpy()
+    return csr_matrix((np.ones(self.nnz, dtype=np.int8), self.indices, self.indptr), shape=self.shape)
+
+  def __repr__(self):
+    return '<%s: %d x %d, nnz=%d>' % (self.__class__.__name__, self.shape[0], self.shape[1], self.nnz)
+
+
+def feature_matrix(rows, generator, vocab=None):
+  """
+  Build a SparseFeatureMatrix straight from a stream of rows, without materializing the
+  feature sets of the candidates
+    * rows: iterable of (tree, cands) pairs, where cands is a list of candidates in the tree
+    * generator: a batch generator, e.g. compile_relation_feature_generator(is_batch=True)
+    * vocab: a FeatureVocabulary; if not frozen, it is built as we go, and then frozen with
+      its min_count cutoff (dropping the columns of rare features)
+  There is one matrix row per candidate, in order; returns (matrix, vocab)
+  """
+  np = _numpy()
+  vocab = FeatureVocabulary() if vocab is None else vocab
+  indptr = array('q', [0])
+  indices = array('i')
+  for tree, cands in rows:
+    feats = [[] for _ in cands]
+    for k, f in generator(tree, cands):
+      feats[k].append(f)
+    for fs in feats:
+      indices.extend(vocab.add_row(fs))
+      indptr.append(len(indices))
+  indptr = np.frombuffer(indptr, dtype=np.int64).copy()
+  indices = np.frombuffer(indices, dtype=np.int32).copy()
+
+  # Apply the min count cutoff: remap the column ids, dropping the pruned columns
+  if not vocab.frozen:
+    remap = np.frombuffer(vocab.freeze(), dtype=np.int32)
+    if len(remap) > len(vocab):
+      indices = remap[indices]
+      keep = indices >= 0
+      indptr = np.concatenate(([0], np.cumsum(keep)))[indptr]
+      indices = indices[keep]
+  return SparseFeatureMatrix(indptr, indices, len(vocab)), vocab
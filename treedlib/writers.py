@@ -0,0 +1,251 @@
+"""
+Buffered bulk writers of extractor output, in Postgres COPY text (i.e. TSV) or binary format
+Records are formatted into a buffer which is written out in large blocks, rather than with a
+print() per record; output can also be sharded across several files, e.g. for parallel loads
+(one COPY per shard). Binary output skips text escaping & parsing altogether, but the column
+types must match those of the table exactly, e.g. ['bigint', 'text[]']
+"""
+import os
+import struct
+import zlib
+from treedlib.util import format_tsv
+
+COPY_BUFFER_SIZE = 1 << 20
+
+# Binary COPY file framing: signature, flags & header extension length; the trailer is a -1 field count
+PG_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PG_COPY_TRAILER = struct.pack('!h', -1)
+
+# Type name -> (type oid, struct of the (length, value) of a fixed size value, or None for text)
+PG_BINARY_TYPES = {
+  'text' : (25, None),
+  'int' : (23, struct.Struct('!ii')),
+  'bigint' : (20, struct.Struct('!iq')),
+  'float' : (701, struct.Struct('!id')),
+  'boolean' : (16, struct.Struct('!i?'))
+}
+
+_FIELD_COUNT = struct.Struct('!h')
+_LENGTH = struct.Struct('!i')
+_NULL = _LENGTH.pack(-1)
+_ARRAY_HEADER = struct.Struct('!iii')
+_ARRAY_DIM = struct.Struct('!ii')
+
+
+def _compile_binary_encoder(t):
+  """Compile an encoder of a value of type t as a binary COPY field, i.e. its length & data"""
+  if t.endswith('[]'):
+    base = t[:-2]
+    if base not in PG_BINARY_TYPES:
+      raise ValueError("Unsupported binary COPY type: %s" % t)
+    oid = PG_BINARY_TYPES[base][0]
+    encode_base = _compile_binary_encoder(base)
+    def encode(x):
+      if x is None:
+        return _NULL
+      elif len(x) == 0:
+        data = _ARRAY_HEADER.pack(0, 0, oid)
+      else:
+        data = _ARRAY_HEADER.pack(1, int(None in x), oid) + _ARRAY_DIM.pack(len(x), 1) \
+          + b''.join([encode_base(e) for e in x])
+      return _LENGTH.pack(len(data)) + data
+    return encode
+
+  try:
+    fixed = PG_BINARY_TYPES[t][1]
+  except KeyError:
+    raise ValueError("Unsupported binary COPY type: %s" % t)
+  if fixed is None:
+    def encode(x):
+      if x is None:
+        return _NULL
+      b = (x if type(x) is str else str(x)).encode('utf-8')
+      return _LENGTH.pack(len(b)) + b
+  else:
+    size = fixed.size - _LENGTH.size
+    def encode(x):
+      return _NULL if x is None else fixed.pack(size, x)
+  return encode
+
+def compile_binary_row_encoder(types):
+  """Compile an encoder of a record (tuple) with the given column types as a binary COPY row"""
+  encoders = [_compile_binary_encoder(t) for t in types]
+  n = len(encoders)
+  count = _FIELD_COUNT.pack(n)
+  def encode(record):
+    if len(record) != n:
+      raise ValueError("%s values for %s columns: %s" % (len(record), n, record))
+    return count + b''.join([e(x) for e, x in zip(encoders, record)])
+  return encode
+
+
+class CopyWriter:
+  """
+  A buffered writer of records (tuples) to a file, either in COPY text format (as format_tsv
+  lines), or in binary COPY format with the given column types
+    * f: path of the file to write, or a file object (text files are written via their buffer)
+    * buffer_size: (approx.) number of characters or bytes buffered between writes
+  Use as a context manager, or call close() to flush the output (& write the binary trailer)
+  """
+  def __init__(self, f, types=None, binary=False, buffer_size=COPY_BUFFER_SIZE):
+    if binary and types is None:
+      raise ValueError("Binary COPY output needs the column types")
+    self.types = types
+    self.binary = binary
+    self.buffer_size = buffer_size
+    self.rows = 0
+    self._own = isinstance(f, str)
+    if self._own:
+      f = open(f, 'wb')
+    elif hasattr(f, 'buffer'):
+      f.flush()
+      f = f.buffer
+    self.f = f
+    self.encode = compile_binary_row_encoder(types) if binary else format_tsv
+    self._buf = []
+    self._size = 0
+    if binary:
+      self.f.write(PG_COPY_HEADER)
+
+  def write(self, record):
+    row = self.encode(record)
+    self._buf.append(row)
+    self._size += len(row) + 1
+    self.rows += 1
+    if self._size >= self.buffer_size:
+      self.flush()
+
+  def write_many(self, records):
+    encode, buf = self.encode, self._buf
+    for record in records:
+      row = encode(record)
+      buf.append(row)
+      self._size += len(row) + 1
+      self.rows += 1
+      if self._size >= self.buffer_size:
+        self.flush()
+        buf = self._buf
+
+  def write_formatted(self, rows, keys=None):
+    """
+    Write a batch of rows already formatted by self.encode, e.g. in worker processes
+    (keys is for compatibility with ShardedCopyWriter, and is ignored)
+    """
+    self._buf.extend(rows)
+    self._size += sum(map(len, rows)) + len(rows)
+    self.rows += len(rows)
+    if self._size >= self.buffer_size:
+      self.flush()
+
+  def flush(self):
+    if len(self._buf) > 0:
+      if self.binary:
+        self.f.write(b''.join(self._buf))
+      else:
+        self._buf.append('')
+        self.f.write('\n'.join(self._buf).encode('utf-8'))
+      self._buf = []
+      self._size = 0
+    self.f.flush()
+
+  def close(self):
+    if self.f is None:
+      return
+    self.flush()
+    if self.binary:
+      self.f.write(PG_COPY_TRAILER)
+    if self._own:
+      self.f.close()
+    else:
+      self.f.flush()
+    self.f = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __repr__(self):
+    return '<%s %s: %d rows%s>' % (self.__class__.__name__, getattr(self.f, 'name', self.f), self.rows,
+                                   ', binary' if self.binary else '')
+
+
+def shard_paths(path, n_shards):
+  """Get the paths of the shards of output path, e.g. features.tsv -> features.0.tsv, ..."""
+  root, ext = os.path.splitext(path)
+  return ['%s.%d%s' % (root, i, ext) for i in range(n_shards)]
+
+class ShardedCopyWriter:
+  """
+  Writes records across n_shards CopyWriters (at shard_paths(path, n_shards)), row by row: by a
+  stable hash of column shard_by if given- so that e.g. all the rows of a candidate land in the
+  same shard- and round robin otherwise. Batches of formatted rows can't be read back, so with
+  shard_by their keys (i.e. column shard_by of each row) must be passed to write_formatted
+  """
+  def __init__(self, path, n_shards, shard_by=None, **kwargs):
+    self.paths = shard_paths(path, n_shards)
+    self.writers = [CopyWriter(p, **kwargs) for p in self.paths]
+    self.shard_by = shard_by
+    self._next = 0
+
+  @property
+  def rows(self):
+    return sum(w.rows for w in self.writers)
+
+  def _round_robin(self):
+    i = self._next
+    self._next = (i + 1) % len(self.writers)
+    return self.writers[i]
+
+  def _shard_index(self, k):
+    if not isinstance(k, int):
+      k = zlib.crc32(str(k).encode('utf-8'))
+    return k % len(self.writers)
+
+  def shard(self, record):
+    """Get the writer of a record"""
+    if self.shard_by is None:
+      return self._round_robin()
+    return self.writers[self._shard_index(record[self.shard_by])]
+
+  def write(self, record):
+    self.shard(record).write(record)
+
+  def write_many(self, records):
+    for record in records:
+      self.shard(record).write(record)
+
+  def write_formatted(self, rows, keys=None):
+    """Write a batch of formatted rows, given their keys if shard_by is set (see class doc)"""
+    n = len(self.writers)
+    if self.shard_by is not None:
+      if keys is None or len(keys) != len(rows):
+        raise ValueError("Sharding formatted rows by column %s needs a key per row" % self.shard_by)
+      idxs = [self._shard_index(k) for k in keys]
+    else:
+      idxs = [(self._next + i) % n for i in range(len(rows))]
+      self._next = (self._next + len(rows)) % n
+    shards = [[] for _ in range(n)]
+    for i, row in zip(idxs, rows):
+      shards[i].append(row)
+    for w, shard in zip(self.writers, shards):
+      if len(shard) > 0:
+        w.write_formatted(shard)
+
+  def flush(self):
+    for w in self.writers:
+      w.flush()
+
+  def close(self):
+    for w in self.writers:
+      w.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __repr__(self):
+    return '<%s %s x %d: %d rows>' % (self.__class__.__name__, self.paths[0], len(self.writers), self.rows)